@@ -1,46 +1,198 @@
-from datetime import datetime, timedelta
+from datetime import timedelta
 from typing import Optional
-from jose import JWTError, jwt
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import base64
+import hashlib
+import json
+import secrets
+import threading
+import time
+from cachetools import TTLCache
+from cryptography.hazmat.primitives.serialization import load_pem_private_key, load_pem_public_key
+from psycopg2.extensions import cursor as TupleCursor
+import jwt
+from jwt.exceptions import InvalidTokenError
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import os
 from dotenv import load_dotenv
-from database import get_db_cursor
+from database import get_db_cursor, release_db_cursor, execute_prepared
+import cache
 
 load_dotenv()
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 1440))
+_DEFAULT_TOKEN_TTL = ACCESS_TOKEN_EXPIRE_MINUTES * 60
+# PEM private key used instead of SECRET_KEY when ALGORITHM is RS*/ES*/PS*;
+# the public key is derived from it unless JWT_PUBLIC_KEY_FILE is also set
+JWT_PRIVATE_KEY_FILE = os.getenv("JWT_PRIVATE_KEY_FILE")
+JWT_PUBLIC_KEY_FILE = os.getenv("JWT_PUBLIC_KEY_FILE")
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+def _load_token_keys():
+    """Returns (signing_key, verifying_key), parsed once at import.
+
+    HMAC secrets are pre-encoded and PEM keys pre-loaded, so PyJWT never
+    re-parses key material per token.
+    """
+    if ALGORITHM and not ALGORITHM.startswith("HS"):
+        if not JWT_PRIVATE_KEY_FILE:
+            raise RuntimeError(
+                f"ALGORITHM={ALGORITHM} signs tokens with a key pair: set JWT_PRIVATE_KEY_FILE "
+                "to a PEM private key (and optionally JWT_PUBLIC_KEY_FILE to its PEM public key)"
+            )
+        with open(JWT_PRIVATE_KEY_FILE, "rb") as key_file:
+            private_key = load_pem_private_key(key_file.read(), password=None)
+        if not JWT_PUBLIC_KEY_FILE:
+            return private_key, private_key.public_key()
+        with open(JWT_PUBLIC_KEY_FILE, "rb") as key_file:
+            return private_key, load_pem_public_key(key_file.read())
+    secret = SECRET_KEY.encode() if SECRET_KEY else None
+    return secret, secret
+
+_SIGNING_KEY, _VERIFYING_KEY = _load_token_keys()
+
+ROLE_ADMIN = "ADMIN"
+ROLE_STAFF = "STAFF"
+_STAFF_ROLES = frozenset({ROLE_ADMIN, ROLE_STAFF})
+
+# Argon2id is memory-hard, so GPU cracking gains little over the server's own
+# cost. Existing bcrypt hashes still verify and are upgraded at next login.
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", 2))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", 65536))  # KiB
+ARGON2_PARALLELISM = int(os.getenv("ARGON2_PARALLELISM", 1))
+
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__type="ID",
+    argon2__time_cost=ARGON2_TIME_COST,
+    argon2__memory_cost=ARGON2_MEMORY_COST,
+    argon2__parallelism=ARGON2_PARALLELISM,
+)
 security = HTTPBearer()
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+# Password hashing is CPU-bound; async handlers run it on this pool, sized to
+# the cores, so it neither blocks the event loop nor oversubscribes the CPU.
+_HASH_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="password-hash")
+
+# Verified against when a login email is unknown, so missing and existing
+# users cost the same hashing work and can't be told apart by timing. It must
+# use the scheme most stored hashes use: bcrypt (cost 12, like the seeded
+# admin) until logins have upgraded most users to argon2, then set
+# LOGIN_DUMMY_HASH_SCHEME=argon2.
+LOGIN_DUMMY_HASH_SCHEME = os.getenv("LOGIN_DUMMY_HASH_SCHEME", "bcrypt")
+_DUMMY_HASH = (
+    pwd_context.hash(secrets.token_urlsafe(16))
+    if LOGIN_DUMMY_HASH_SCHEME == "argon2"
+    else pwd_context.handler("bcrypt").using(rounds=12).hash(secrets.token_urlsafe(16))
+)
+
+# Decoded JWT payloads keyed by a digest of the raw token, so repeat requests
+# with the same token skip signature verification. Only valid tokens are cached.
+_JWT_CACHE = TTLCache(maxsize=10_000, ttl=_DEFAULT_TOKEN_TTL)
+_JWT_CACHE_LOCK = threading.Lock()
+_TOKEN_DIGEST_KEY = (SECRET_KEY or "").encode()[:64]
+
+# Short-lived cache of user rows keyed by user id, so authenticated requests
+# skip the users lookup. Call invalidate_user() after changing a user.
+# With Redis configured rows are shared across workers for USER_CACHE_TTL.
+# The per-process copy is kept only briefly either way: invalidate_user() can
+# only clear the calling worker's copy, so a role or approval change must
+# reach the other workers within seconds.
+USER_CACHE_TTL = 60
+USER_LOCAL_CACHE_TTL = 5
+_USER_CACHE = TTLCache(maxsize=5_000, ttl=USER_LOCAL_CACHE_TTL)
+_USER_CACHE_LOCK = threading.Lock()
+_USER_COLUMNS = ("id", "name", "email", "role", "is_approved", "default_warehouse_id")
+
+def _is_password_hash(hashed_password) -> bool:
+    if not isinstance(hashed_password, str):
+        return False
+    if hashed_password.startswith("$argon2"):
+        return True
+    return len(hashed_password) == 60 and hashed_password.startswith("$2")
+
+def verify_user_password(user, plain_password):
+    """Checks a password against a user row, spending a full verify even if the user is missing.
+
+    Returns (verified, new_hash); new_hash is set when the stored hash uses
+    outdated settings and should be replaced.
+    """
+    if not plain_password:
+        return False, None
+    hashed_password = user["password_hash"] if user is not None else None
+    if not _is_password_hash(hashed_password):
+        # Missing user or unusable stored hash: same work as a real verify
+        pwd_context.verify(plain_password, _DUMMY_HASH)
+        return False, None
+    return pwd_context.verify_and_update(plain_password, hashed_password)
 
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+async def averify_user_password(user, plain_password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_HASH_POOL, verify_user_password, user, plain_password)
+
+async def aget_password_hash(password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_HASH_POOL, get_password_hash, password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+    ttl = int(expires_delta.total_seconds()) if expires_delta else _DEFAULT_TOKEN_TTL
+    return jwt.encode({**data, "exp": int(time.time()) + ttl}, _SIGNING_KEY, algorithm=ALGORITHM)
+
+def _token_cache_key(token: str) -> bytes:
+    # Keyed with the signing secret, so cache keys can't be matched against
+    # tokens by anyone without it
+    return hashlib.blake2b(token.encode(), digest_size=16, key=_TOKEN_DIGEST_KEY).digest()
+
+def _has_expected_header(token: str) -> bool:
+    """Cheap structural check run before any signature work."""
+    parts = token.split(".")
+    if len(parts) != 3:
+        return False
+    try:
+        header = json.loads(base64.urlsafe_b64decode(parts[0] + "=" * (-len(parts[0]) % 4)))
+    except ValueError:
+        return False
+    return isinstance(header, dict) and header.get("alg") == ALGORITHM
 
 def decode_token(token: str):
+    key = _token_cache_key(token)
+    with _JWT_CACHE_LOCK:
+        payload = _JWT_CACHE.get(key)
+    if payload is not None:
+        exp = payload.get("exp")
+        if exp is None or exp > time.time():
+            return payload
+        with _JWT_CACHE_LOCK:
+            _JWT_CACHE.pop(key, None)
+        return None
+
+    if not _has_expected_header(token):
+        return None
+
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
-    except JWTError:
+        payload = jwt.decode(token, _VERIFYING_KEY, algorithms=[ALGORITHM])
+    except InvalidTokenError:
         return None
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    with _JWT_CACHE_LOCK:
+        _JWT_CACHE[key] = payload
+    return payload
+
+async def get_current_user_id(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Returns the user id from a valid token without loading the user row.
+
+    Routes should depend on get_current_user instead, which also rejects
+    tokens of users that have since been deleted.
+    """
     token = credentials.credentials
     payload = decode_token(token)
 
@@ -56,33 +208,75 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials",
         )
+    return user_id
 
-    conn, cursor = get_db_cursor()
+def _load_user(user_id: str):
+    # Plain tuple rows: the one row is turned into the cached dict directly
+    conn, cursor = get_db_cursor(cursor_factory=TupleCursor)
     try:
-        cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-        user = cursor.fetchone()
-        if user is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="User not found",
-            )
-        return dict(user)
+        execute_prepared(
+            cursor,
+            "get_user_by_id",
+            f"SELECT {', '.join(_USER_COLUMNS)} FROM users WHERE id = $1",
+            (user_id,)
+        )
+        row = cursor.fetchone()
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
+    return dict(zip(_USER_COLUMNS, row)) if row is not None else None
+
+def _user_cache_key(user_id: str) -> str:
+    return f"user:{user_id}"
+
+def _fetch_user(user_id: str):
+    """Reads a user row through the shared Redis cache, then the database."""
+    key = _user_cache_key(user_id)
+    user = cache.get_json(key)
+    if user is None:
+        user = _load_user(user_id)
+        if user is not None:
+            cache.set_json(key, user, USER_CACHE_TTL)
+    return user
+
+async def get_current_user(user_id: str = Depends(get_current_user_id)):
+    # Async so cache hits resolve on the event loop without a threadpool hop;
+    # only a cache miss goes to the database in a worker thread
+    with _USER_CACHE_LOCK:
+        user = _USER_CACHE.get(user_id)
+    if user is not None:
+        return user
+
+    user = await run_in_threadpool(_fetch_user, user_id)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found",
+        )
+
+    with _USER_CACHE_LOCK:
+        _USER_CACHE[user_id] = user
+    return user
+
+def invalidate_user(user_id: str):
+    """Drops a cached user row so the next request reloads it."""
+    with _USER_CACHE_LOCK:
+        _USER_CACHE.pop(str(user_id), None)
+    cache.delete(_user_cache_key(user_id))
 
-def require_admin(current_user: dict = Depends(get_current_user)):
+# The guards below reuse the get_current_user dependency itself (not a wrapper)
+# so FastAPI resolves it once per request even when several guards apply.
+async def require_admin(current_user: dict = Depends(get_current_user)):
     """Requires user to have ADMIN role. Raises 403 if not."""
-    if current_user["role"] != "ADMIN":
+    if current_user["role"] != ROLE_ADMIN:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Admin privileges required. Only admins can perform this action.",
         )
     return current_user
 
-def allow_staff(current_user: dict = Depends(get_current_user)):
+async def allow_staff(current_user: dict = Depends(get_current_user)):
     """Allows both ADMIN and STAFF roles. Just validates authentication."""
-    if current_user["role"] not in ["ADMIN", "STAFF"]:
+    if current_user["role"] not in _STAFF_ROLES:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Staff or Admin privileges required",
@@ -0,0 +1,126 @@
+"""
+Optional Redis cache shared by all API workers.
+
+Set REDIS_URL to enable it. Without it (or without the redis package) every
+lookup is a miss and writes are dropped, so callers fall back to the database.
+Redis errors are treated the same way: the cache never fails a request.
+"""
+
+import json
+import os
+from dotenv import load_dotenv
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+load_dotenv()
+
+REDIS_URL = os.getenv("REDIS_URL")
+
+_client = (
+    redis.Redis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+    if redis is not None and REDIS_URL
+    else None
+)
+
+def get_json(key: str):
+    """Returns the decoded value stored at key, or None on a miss."""
+    if _client is None:
+        return None
+    try:
+        raw = _client.get(key)
+    except redis.RedisError:
+        return None
+    return json.loads(raw) if raw is not None else None
+
+def set_json(key: str, value, ttl: int):
+    """Stores value as JSON under key for ttl seconds."""
+    if _client is None:
+        return
+    try:
+        _client.setex(key, ttl, json.dumps(value, default=str))
+    except redis.RedisError:
+        pass
+
+def get_bytes(key: str):
+    """Returns the raw bytes stored at key, or None on a miss."""
+    if _client is None:
+        return None
+    try:
+        return _client.get(key)
+    except redis.RedisError:
+        return None
+
+def set_bytes(key: str, value: bytes, ttl: int):
+    """Stores raw bytes under key for ttl seconds."""
+    if _client is None:
+        return
+    try:
+        _client.setex(key, ttl, value)
+    except redis.RedisError:
+        pass
+
+def set_text(key: str, value: str, ttl: int) -> bool:
+    """Stores a string under key for ttl seconds.
+
+    Returns False when Redis is not configured or the write failed, so callers
+    that need the value kept can store it elsewhere.
+    """
+    if _client is None:
+        return False
+    try:
+        _client.setex(key, ttl, value)
+    except redis.RedisError:
+        return False
+    return True
+
+def get_text(key: str):
+    """Returns the string stored at key, or None on a miss."""
+    if _client is None:
+        return None
+    try:
+        raw = _client.get(key)
+    except redis.RedisError:
+        return None
+    return raw.decode() if raw is not None else None
+
+def incr_window(key: str, window: int):
+    """Counts a hit on a counter that resets window seconds after its first hit.
+
+    Returns (count, seconds left in the window), or None when Redis is not
+    available.
+    """
+    if _client is None:
+        return None
+    try:
+        pipe = _client.pipeline()
+        # SET NX starts a new window with its expiry; INCR keeps the TTL
+        pipe.set(key, 0, ex=window, nx=True)
+        pipe.incr(key)
+        pipe.ttl(key)
+        _, count, ttl = pipe.execute()
+    except redis.RedisError:
+        return None
+    return count, ttl
+
+def delete(*keys: str) -> int:
+    """Deletes keys and returns how many existed."""
+    if _client is None or not keys:
+        return 0
+    try:
+        return _client.delete(*keys)
+    except redis.RedisError:
+        return 0
+
+def delete_pattern(pattern: str):
+    """Deletes every key matching a glob-style pattern."""
+    if _client is None:
+        return
+    try:
+        keys = list(_client.scan_iter(match=pattern, count=500))
+        if keys:
+            _client.delete(*keys)
+    except redis.RedisError:
+        pass
@@ -1,19 +1,16 @@
-from database import get_db_cursor
+from database import get_db
 
-conn, cursor = get_db_cursor()
+with get_db() as conn, conn.cursor() as cursor:
+    # Check stock_movements
+    cursor.execute("""
+        SELECT column_name, data_type
+        FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = 'stock_movements'
+        ORDER BY ordinal_position
+    """)
+    rows = cursor.fetchall()
 
-# Check stock_movements
-cursor.execute("""
-    SELECT column_name, data_type 
-    FROM information_schema.columns 
-    WHERE table_name = 'stock_movements'
-    ORDER BY ordinal_position
-""")
-rows = cursor.fetchall()
 print("\nstock_movements table structure:")
 print("="*40)
 for row in rows:
     print(f"{row['column_name']}: {row['data_type']}")
-
-cursor.close()
-conn.close()
@@ -3,7 +3,8 @@
 
 import sys
 import getpass
-from database import get_db_cursor
+from concurrent.futures import ThreadPoolExecutor
+from database import get_db_cursor, release_db_cursor
 from auth import get_password_hash
 
 def create_admin():
@@ -24,42 +25,51 @@ def create_admin():
         print("❌ Invalid email address!")
         return False
     
-    # Get password securely (hidden input)
+    # Get password securely (hidden input). Hashing starts in the background
+    # as soon as a password is entered, overlapping the confirmation prompt
+    # and the database connect. A retry with the same password reuses the
+    # pending hash; otherwise the stale one is cancelled so retries don't queue
+    # up behind abandoned hashes.
+    executor = ThreadPoolExecutor(max_workers=1)
+    hash_future, hashed_password = None, None
     while True:
         password = getpass.getpass("Password (min 6 characters): ")
         if len(password) < 6:
             print("❌ Password must be at least 6 characters!")
             continue
         
+        if hash_future is None or password != hashed_password:
+            if hash_future is not None:
+                hash_future.cancel()
+            hash_future = executor.submit(get_password_hash, password)
+            hashed_password = password
         password_confirm = getpass.getpass("Confirm Password: ")
         if password != password_confirm:
             print("❌ Passwords do not match!")
             continue
         
         break
+    executor.shutdown(wait=False)
     
     # Connect to database
     conn, cursor = get_db_cursor()
     try:
-        # Check if email already exists
-        cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
-        existing_user = cursor.fetchone()
+        password_hash = hash_future.result()
         
-        if existing_user:
-            print(f"\n❌ User with email '{email}' already exists!")
-            return False
-        
-        # Hash password
-        password_hash = get_password_hash(password)
-        
-        # Insert admin user (auto-approved)
+        # Insert admin user (auto-approved); no row back means the email is taken
         cursor.execute(
             """INSERT INTO users (name, email, password_hash, role, is_approved)
-               VALUES (%s, %s, %s, %s, %s) RETURNING id, email, role, created_at""",
+               VALUES (%s, %s, %s, %s, %s)
+               ON CONFLICT (email) DO NOTHING
+               RETURNING id, email, role, created_at""",
             (name, email, password_hash, 'ADMIN', True)
         )
-        conn.commit()
         new_user = cursor.fetchone()
+        conn.commit()
+        
+        if not new_user:
+            print(f"\n❌ User with email '{email}' already exists!")
+            return False
         
         print("\n" + "=" * 50)
         print("✅ ADMIN USER CREATED SUCCESSFULLY!")
@@ -77,8 +87,7 @@ def create_admin():
         print(f"\n❌ Error creating admin: {e}")
         return False
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
 
 def list_admins():
     """List all current admin users."""
@@ -104,8 +113,7 @@ def list_admins():
     except Exception as e:
         print(f"❌ Error: {e}")
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
 
 def delete_user():
     """Delete a user by email."""
@@ -152,8 +160,7 @@ def delete_user():
         print(f"\n❌ Error deleting user: {e}")
         return False
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
 
 def main():
     """Main menu."""
@@ -1,21 +1,185 @@
 import os
+import re
+import threading
+import time
 from dotenv import load_dotenv
 import psycopg2
+from psycopg2.extensions import connection
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 from contextlib import contextmanager
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 2))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 20))
+# Seconds to wait for a free pooled connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 2.0))
+# Connections idle longer than this many seconds are pinged before reuse, since
+# the server or a pooler in between may have dropped them in the meantime
+DB_POOL_PING_IDLE = float(os.getenv("DB_POOL_PING_IDLE", 30))
+# Server-side PREPARE is session state, which transaction-mode poolers
+# (PgBouncer, Supabase's port 6543 pooler) don't keep; set to false behind one
+DB_SERVER_PREPARE = os.getenv("DB_SERVER_PREPARE", "true").lower() not in ("0", "false", "no")
+_DOLLAR_PARAM = re.compile(r"\$(\d+)")
+
+class PoolTimeout(Exception):
+    """No pooled connection became free within DB_POOL_TIMEOUT."""
+
+class PooledConnection(connection):
+    """Connection that remembers which statements it has PREPAREd."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+        self.released_at = time.monotonic()
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+# ThreadedConnectionPool raises PoolError when exhausted instead of waiting,
+# so callers queue on this semaphore for a free connection first.
+_POOL_SLOTS = threading.BoundedSemaphore(DB_POOL_MAX)
+
+def _get_pool():
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL,
+                    connection_factory=PooledConnection, cursor_factory=RealDictCursor
+                )
+    return _POOL
+
+def init_pool():
+    """Opens the pool and round-trips each of its DB_POOL_MIN connections.
+
+    Run at startup so the first requests find warm, verified connections.
+    """
+    _get_pool()
+    conns = [_acquire_conn() for _ in range(DB_POOL_MIN)]
+    try:
+        for conn in conns:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+    finally:
+        for conn in conns:
+            release_db_conn(conn)
+
+def close_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.closeall()
+            _POOL = None
+
+def _is_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.released_at < DB_POOL_PING_IDLE:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _acquire_conn():
+    if not _POOL_SLOTS.acquire(timeout=DB_POOL_TIMEOUT):
+        raise PoolTimeout(f"No database connection available within {DB_POOL_TIMEOUT}s")
+    try:
+        pool = _get_pool()
+        conn = pool.getconn()
+        if not _is_alive(conn):
+            # Dropped while idle: discard it and open a fresh one
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+        return conn
+    except Exception:
+        _POOL_SLOTS.release()
+        raise
+
+def release_db_conn(conn):
+    """Return a connection to the pool, rolling back any open transaction."""
+    pool = _get_pool()
+    conn.released_at = time.monotonic()
+    try:
+        pool.putconn(conn)
+    except Exception:
+        # Rollback failed on a broken connection: drop it instead of reusing it
+        pool.putconn(conn, close=True)
+    finally:
+        _POOL_SLOTS.release()
 
 @contextmanager
 def get_db():
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+    conn = _acquire_conn()
     try:
         yield conn
     finally:
-        conn.close()
+        release_db_conn(conn)
+
+@contextmanager
+def db_transaction():
+    """Yields a cursor on a pooled connection inside a single transaction.
+
+    Commits when the block exits normally and rolls back if it raises.
+    """
+    with get_db() as conn:
+        with conn, conn.cursor() as cursor:
+            yield cursor
+
+def get_db_cursor(cursor_factory=None, name=None):
+    """Checks out a pooled connection and opens a cursor on it.
+
+    Cursors return RealDictRow rows unless another cursor_factory is given.
+    A name opens a server-side cursor, which fetches rows in batches instead
+    of loading the whole result on execute.
+    """
+    conn = _acquire_conn()
+    return conn, conn.cursor(name=name, cursor_factory=cursor_factory)
+
+def release_db_cursor(conn, cursor):
+    cursor.close()
+    release_db_conn(conn)
+
+def fetch_all(query, params=None):
+    """Runs a read-only query on a pooled connection and returns every row."""
+    conn, cursor = get_db_cursor()
+    try:
+        cursor.execute(query, params)
+        return cursor.fetchall()
+    finally:
+        release_db_cursor(conn, cursor)
+
+def fetch_one(query, params=None):
+    """Runs a read-only query on a pooled connection and returns its first row, or None."""
+    conn, cursor = get_db_cursor()
+    try:
+        cursor.execute(query, params)
+        return cursor.fetchone()
+    finally:
+        release_db_cursor(conn, cursor)
+
+def execute_prepared(cursor, name, sql, params):
+    """Runs sql as a named server-side prepared statement.
 
-def get_db_cursor():
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-    return conn, conn.cursor()
+    The statement is PREPAREd the first time a pooled connection sees it, so
+    later calls skip parsing and planning. sql uses $1..$n placeholders.
+    With DB_SERVER_PREPARE off it is sent as an ordinary parameterized query.
+    """
+    if not DB_SERVER_PREPARE:
+        cursor.execute(
+            _DOLLAR_PARAM.sub(r"%(p\1)s", sql),
+            {f"p{i}": value for i, value in enumerate(params, 1)}
+        )
+        return
+    conn = cursor.connection
+    if name not in conn.prepared_statements:
+        cursor.execute(f"PREPARE {name} AS {sql}")
+        conn.prepared_statements.add(name)
+    placeholders = ", ".join(["%s"] * len(params))
+    cursor.execute(f"EXECUTE {name} ({placeholders})", params)
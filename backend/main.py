@@ -1,19 +1,146 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, BackgroundTasks, Depends, HTTPException, Query, Request, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
+from psycopg2.extras import execute_values
+from decimal import Decimal
+import anyio
+import asyncio
+import csv
+import io
+import itertools
+import logging
+import orjson
+import os
+import threading
+from cachetools import TTLCache
 from pydantic import BaseModel
 from typing import Optional, List
 from datetime import date, datetime
-from database import get_db_cursor
+from database import (
+    get_db_cursor,
+    release_db_cursor,
+    fetch_all,
+    fetch_one,
+    execute_prepared,
+    DB_POOL_MAX,
+    init_pool,
+    close_pool,
+    PoolTimeout
+)
+import cache
 from auth import (
-    get_password_hash,
-    verify_password,
+    aget_password_hash,
+    averify_user_password,
     create_access_token,
     get_current_user,
     require_admin,
-    allow_staff
+    allow_staff,
+    invalidate_user
 )
 
-app = FastAPI(title="StockTrace API")
+def _encode_decimal(value):
+    # NUMERIC columns arrive as Decimal, which orjson leaves to a default hook;
+    # mirrors jsonable_encoder so responses keep the same numbers
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    raise TypeError
+
+class RowsResponse(ORJSONResponse):
+    """Serializes database rows straight to JSON bytes.
+
+    Returning one of these from a handler skips FastAPI's jsonable_encoder pass,
+    which otherwise walks and copies every row before orjson sees it.
+    """
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_encode_decimal)
+
+STREAM_BATCH_SIZE = 2000
+# A streamed response keeps its pooled connection until the client has read
+# the last byte, so a slow client holds it for as long as it takes to read.
+# Only this many streams may hold connections at once, so the rest of the pool
+# stays free for ordinary requests; past that, results are sent buffered.
+STREAM_MAX_CONCURRENT = int(os.getenv("STREAM_MAX_CONCURRENT", max(1, DB_POOL_MAX // 4)))
+_STREAM_SLOTS = threading.BoundedSemaphore(STREAM_MAX_CONCURRENT)
+
+def _encode_rows(rows) -> bytes:
+    return b",".join(orjson.dumps(row, default=_encode_decimal) for row in rows)
+
+def stream_rows(query, params=None):
+    """Sends a large query result to the client as one JSON array.
+
+    Rows are read through a server-side cursor STREAM_BATCH_SIZE at a time, so
+    memory stays flat however many rows match, and the pooled connection is
+    held until the response has been sent. A result that fits in the first
+    batch, or any result while all STREAM_MAX_CONCURRENT streams are busy, is
+    sent as an ordinary buffered response instead.
+
+    The status line goes out with the first batch, so an error after that
+    can only abort the response; the client sees an incomplete body rather
+    than a clean error.
+    """
+    if not _STREAM_SLOTS.acquire(blocking=False):
+        return RowsResponse(fetch_all(query, params))
+    try:
+        conn, cursor = get_db_cursor(name="stream_rows")
+    except Exception:
+        _STREAM_SLOTS.release()
+        raise
+    released = False
+    release_lock = threading.Lock()
+
+    def release():
+        # Called from the body iterator and the background task, possibly on
+        # different threads; only the first call returns the connection
+        nonlocal released
+        with release_lock:
+            if released:
+                return
+            released = True
+        try:
+            release_db_cursor(conn, cursor)
+        finally:
+            _STREAM_SLOTS.release()
+
+    # Query errors surface here, before any response has started
+    try:
+        cursor.execute(query, params)
+        first = cursor.fetchmany(STREAM_BATCH_SIZE)
+    except Exception:
+        release()
+        raise
+    if len(first) < STREAM_BATCH_SIZE:
+        release()
+        return RowsResponse(first)
+
+    def chunks():
+        try:
+            yield b"[" + _encode_rows(first)
+            while True:
+                rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+                if not rows:
+                    break
+                yield b"," + _encode_rows(rows)
+            yield b"]"
+        finally:
+            release()
+
+    # The background task covers clients that disconnect mid-stream, when the
+    # generator is abandoned before its finally runs
+    return StreamingResponse(chunks(), media_type="application/json", background=BackgroundTask(release))
+
+# Uvicorn only configures its own loggers, so records from this app's module
+# loggers (main, password_reset) would otherwise be dropped below WARNING.
+# basicConfig does nothing if the process already set up root logging.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(level=LOG_LEVEL, format="%(levelname)s: %(name)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+# Responses are encoded with orjson (C) instead of the stdlib json module
+app = FastAPI(title="StockTrace API", default_response_class=RowsResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -23,6 +150,54 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Handlers are plain `def` so Starlette runs them in its threadpool and the
+# event loop never waits on psycopg2; connections come from the shared pool.
+# The threadpool is sized so it can keep every pooled connection busy with
+# room to spare for requests that never touch the database.
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", max(40, DB_POOL_MAX * 2)))
+
+@app.on_event("startup")
+async def size_threadpool():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+@app.on_event("startup")
+def open_db_pool():
+    init_pool()
+
+@app.on_event("shutdown")
+def close_db_pool():
+    close_pool()
+
+# Expired OTPs in the database fallback table are swept periodically
+# instead of lingering until the same email requests a new one
+OTP_CLEANUP_INTERVAL = 300
+
+async def purge_otps_periodically():
+    from password_reset import purge_expired_otps
+
+    while True:
+        await asyncio.sleep(OTP_CLEANUP_INTERVAL)
+        try:
+            await run_in_threadpool(purge_expired_otps)
+        except Exception:
+            logger.exception("Error purging expired OTPs")
+
+@app.on_event("startup")
+async def start_otp_cleanup():
+    app.state.otp_cleanup = asyncio.create_task(purge_otps_periodically())
+
+@app.on_event("shutdown")
+async def stop_otp_cleanup():
+    app.state.otp_cleanup.cancel()
+
+@app.exception_handler(PoolTimeout)
+def pool_timeout_handler(request: Request, exc: PoolTimeout):
+    # Fail fast when every connection is busy instead of hanging the request
+    return ORJSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Server is busy. Please try again."},
+    )
+
 class LoginRequest(BaseModel):
     email: str
     password: str
@@ -70,41 +245,68 @@ class DocumentCreate(BaseModel):
     reason: Optional[str] = None
     lines: List[DocumentLineCreate]
 
-@app.post("/auth/login")
-def login(request: LoginRequest):
+def get_user_by_email(email: str):
     conn, cursor = get_db_cursor()
     try:
-        cursor.execute("SELECT * FROM users WHERE email = %s", (request.email,))
-        user = cursor.fetchone()
+        execute_prepared(
+            cursor,
+            "get_user_by_email",
+            """SELECT id, name, email, password_hash, role, is_approved, default_warehouse_id
+               FROM users WHERE email = $1""",
+            (email,)
+        )
+        return cursor.fetchone()
+    finally:
+        release_db_cursor(conn, cursor)
 
-        if not user or not verify_password(request.password, user["password_hash"]):
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Incorrect email or password",
-            )
-        
-        # Check if user is approved
-        if not user.get("is_approved", True):
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Your account is pending approval. Please contact an administrator.",
-            )
+def update_password_hash(user_id: str, password_hash: str):
+    conn, cursor = get_db_cursor()
+    try:
+        cursor.execute(
+            "UPDATE users SET password_hash = %s WHERE id = %s",
+            (password_hash, user_id)
+        )
+        conn.commit()
+    finally:
+        release_db_cursor(conn, cursor)
 
-        access_token = create_access_token(data={"sub": user["id"]})
-        return {
-            "access_token": access_token,
-            "token_type": "bearer",
-            "user": {
-                "id": user["id"],
-                "name": user["name"],
-                "email": user["email"],
-                "role": user["role"],
-                "default_warehouse_id": user["default_warehouse_id"]
-            }
+@app.post("/auth/login")
+async def login(request: LoginRequest, background_tasks: BackgroundTasks):
+    # The lookup runs in the threadpool and the password check on the hashing
+    # pool, so no database connection is held while the hash is verified
+    user = await run_in_threadpool(get_user_by_email, request.email)
+
+    verified, new_hash = await averify_user_password(user, request.password)
+    if not verified:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect email or password",
+        )
+
+    # Approval is checked only after a full verify, so an unapproved account
+    # costs the same as any other and the 403 is shown only to its owner
+    if not user.get("is_approved", True):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Your account is pending approval. Please contact an administrator.",
+        )
+
+    # Legacy bcrypt (or outdated argon2) hash: store the upgraded one after responding
+    if new_hash:
+        background_tasks.add_task(update_password_hash, user["id"], new_hash)
+
+    access_token = create_access_token(data={"sub": user["id"]})
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "user": {
+            "id": user["id"],
+            "name": user["name"],
+            "email": user["email"],
+            "role": user["role"],
+            "default_warehouse_id": user["default_warehouse_id"]
         }
-    finally:
-        cursor.close()
-        conn.close()
+    }
 
 class SignupRequest(BaseModel):
     name: str
@@ -112,31 +314,26 @@ class SignupRequest(BaseModel):
     password: str
     role: Optional[str] = "STAFF"  # Default to STAFF role for new signups
 
-@app.post("/auth/signup")
-def signup(request: SignupRequest):
+def insert_signup_user(request: SignupRequest, password_hash: str):
     conn, cursor = get_db_cursor()
     try:
-        # Check if user already exists
-        cursor.execute("SELECT * FROM users WHERE email = %s", (request.email,))
-        existing_user = cursor.fetchone()
-        
-        if existing_user:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Email already registered",
-            )
-        
-        # Hash the password
-        password_hash = get_password_hash(request.password)
-        
-        # Create new user (requires admin approval by default)
+        # Create new user (requires admin approval by default); no row back
+        # means the email is already taken
         cursor.execute(
             """INSERT INTO users (name, email, password_hash, role, is_approved)
-               VALUES (%s, %s, %s, %s, %s) RETURNING *""",
+               VALUES (%s, %s, %s, %s, %s)
+               ON CONFLICT (email) DO NOTHING
+               RETURNING id, name, email, role, is_approved""",
             (request.name, request.email, password_hash, request.role, False)
         )
-        conn.commit()
         user = cursor.fetchone()
+        conn.commit()
+        
+        if not user:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Email already registered",
+            )
         
         # Return success message (user needs approval before login)
         return {
@@ -150,18 +347,19 @@ def signup(request: SignupRequest):
             }
         }
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
+
+@app.post("/auth/signup")
+async def signup(request: SignupRequest):
+    # Hash on the hashing pool before touching the database, so no pooled
+    # connection is held while the hash is computed
+    password_hash = await aget_password_hash(request.password)
+    return await run_in_threadpool(insert_signup_user, request, password_hash)
 
-@app.get("/auth/me")
+@app.get("/auth/me", response_model=UserResponse)
 def get_me(current_user: dict = Depends(get_current_user)):
-    return {
-        "id": current_user["id"],
-        "name": current_user["name"],
-        "email": current_user["email"],
-        "role": current_user["role"],
-        "default_warehouse_id": current_user["default_warehouse_id"]
-    }
+    # response_model picks the public fields and serializes them in pydantic-core
+    return current_user
 
 # Password Reset Endpoints
 class RequestOTPRequest(BaseModel):
@@ -176,50 +374,74 @@ class ResetPasswordRequest(BaseModel):
     otp: str
     new_password: str
 
+def reject_malformed_otp(email: str, otp: str):
+    """Fails a verify before the rate limiter or database when the input can never match."""
+    from password_reset import is_valid_email, is_valid_otp
+
+    if not is_valid_otp(otp) or not is_valid_email(email):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid or expired OTP"
+        )
+
+def enforce_rate_limit(key: str, limit: int, window: int):
+    from password_reset import check_rate
+
+    retry_after = check_rate(key, limit, window)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many attempts. Please try again later.",
+            headers={"Retry-After": str(retry_after)}
+        )
+
 @app.post("/auth/request-otp")
-def request_password_reset_otp(request: RequestOTPRequest):
+def request_password_reset_otp(request: RequestOTPRequest, background_tasks: BackgroundTasks):
     """Request OTP for password reset"""
-    from password_reset import generate_otp, store_otp, send_otp_email
+    from password_reset import generate_otp, store_otp, send_otp_email, is_valid_email, OTP_SEND_LIMIT, OTP_SEND_WINDOW
     
-    conn, cursor = get_db_cursor()
-    try:
-        # Check if user exists
-        cursor.execute("SELECT email FROM users WHERE email = %s", (request.email,))
-        user = cursor.fetchone()
-        
-        if not user:
-            # Don't reveal if email exists or not for security
-            return {
-                "message": "If the email exists, an OTP has been sent to it."
-            }
-        
-        # Generate and store OTP
-        otp = generate_otp()
-        if not store_otp(request.email, otp):
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to generate OTP. Please try again."
-            )
-        
-        # Send OTP via email
-        if not send_otp_email(request.email, otp):
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to send OTP email. Please try again."
-            )
-        
+    # A malformed address can't belong to a user: same answer, no lookup
+    if not is_valid_email(request.email):
         return {
-            "message": "If the email exists, an OTP has been sent to it.",
-            "otp": otp  # REMOVE THIS IN PRODUCTION! Only for testing
+            "message": "If the email exists, an OTP has been sent to it."
         }
-    finally:
-        cursor.close()
-        conn.close()
+    
+    # Applied before the user lookup, so the limit doesn't reveal whether the email exists
+    enforce_rate_limit(f"otp_send:{request.email.strip().lower()}", OTP_SEND_LIMIT, OTP_SEND_WINDOW)
+    
+    # Check if user exists
+    user = fetch_one("SELECT email FROM users WHERE email = %s", (request.email,))
+    
+    if not user:
+        # Don't reveal if email exists or not for security
+        return {
+            "message": "If the email exists, an OTP has been sent to it."
+        }
+    
+    # Generate and store OTP
+    otp = generate_otp()
+    if not store_otp(request.email, otp):
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to generate OTP. Please try again."
+        )
+    
+    # Sent after the response goes out, so the request doesn't wait on the
+    # email provider; a failed send is logged by send_otp_email
+    background_tasks.add_task(send_otp_email, request.email, otp)
+    
+    return {
+        "message": "If the email exists, an OTP has been sent to it.",
+        "otp": otp  # REMOVE THIS IN PRODUCTION! Only for testing
+    }
 
 @app.post("/auth/verify-otp")
 def verify_password_reset_otp(request: VerifyOTPRequest):
     """Verify OTP without resetting password"""
-    from password_reset import verify_otp
+    from password_reset import verify_otp, OTP_VERIFY_LIMIT, OTP_VERIFY_WINDOW
+    
+    reject_malformed_otp(request.email, request.otp)
+    enforce_rate_limit(f"otp_verify:{request.email.strip().lower()}", OTP_VERIFY_LIMIT, OTP_VERIFY_WINDOW)
     
     # Verify OTP
     if not verify_otp(request.email, request.otp):
@@ -233,19 +455,29 @@ def verify_password_reset_otp(request: VerifyOTPRequest):
     }
 
 @app.post("/auth/reset-password")
-def reset_password_with_otp(request: ResetPasswordRequest):
+async def reset_password_with_otp(request: ResetPasswordRequest):
     """Reset password using OTP"""
-    from password_reset import verify_otp, reset_password_with_otp
+    from password_reset import verify_otp, reset_password_with_otp, OTP_VERIFY_LIMIT, OTP_VERIFY_WINDOW
     
-    # Verify OTP again (for security)
-    if not verify_otp(request.email, request.otp):
+    reject_malformed_otp(request.email, request.otp)
+    
+    # Shares the verify counter: each call here is also an OTP guess
+    await run_in_threadpool(
+        enforce_rate_limit, f"otp_verify:{request.email.strip().lower()}", OTP_VERIFY_LIMIT, OTP_VERIFY_WINDOW
+    )
+    
+    # Verify OTP again (for security); a verified OTP also means the user exists
+    if not await run_in_threadpool(verify_otp, request.email, request.otp):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid or expired OTP"
         )
     
+    # Hash on the hashing pool before any database connection is checked out
+    password_hash = await aget_password_hash(request.new_password)
+    
     # Reset password
-    if not reset_password_with_otp(request.email, request.new_password):
+    if not await run_in_threadpool(reset_password_with_otp, request.email, password_hash):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to reset password. Please try again."
@@ -259,18 +491,11 @@ def reset_password_with_otp(request: ResetPasswordRequest):
 @app.get("/users")
 def get_users(current_user: dict = Depends(require_admin)):
     """Get all users (Admin only)"""
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute("""
-            SELECT id, name, email, role, is_approved, created_at, updated_at
-            FROM users 
-            ORDER BY created_at DESC
-        """)
-        users = cursor.fetchall()
-        return [dict(u) for u in users]
-    finally:
-        cursor.close()
-        conn.close()
+    return fetch_all("""
+        SELECT id, name, email, role, is_approved, created_at, updated_at
+        FROM users 
+        ORDER BY created_at DESC
+    """)
 
 class UserCreate(BaseModel):
     name: str
@@ -282,33 +507,34 @@ class UserUpdate(BaseModel):
     name: str
     role: str
 
-@app.post("/users")
-def create_user(user: UserCreate, current_user: dict = Depends(require_admin)):
-    """Create new user (Admin only) - Auto-approved"""
+def insert_approved_user(user: UserCreate, password_hash: str):
     conn, cursor = get_db_cursor()
     try:
-        # Check if email already exists
-        cursor.execute("SELECT id FROM users WHERE email = %s", (user.email,))
-        if cursor.fetchone():
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Email already registered"
-            )
-        
-        # Hash password and create user (auto-approved since created by admin)
-        password_hash = get_password_hash(user.password)
+        # Create user (auto-approved since created by admin); no row back
+        # means the email is already taken
         cursor.execute(
             """INSERT INTO users (name, email, password_hash, role, is_approved)
                VALUES (%s, %s, %s, %s, %s)
+               ON CONFLICT (email) DO NOTHING
                RETURNING id, name, email, role, is_approved, created_at""",
             (user.name, user.email, password_hash, user.role, True)
         )
-        conn.commit()
         new_user = cursor.fetchone()
-        return dict(new_user)
+        conn.commit()
+        if not new_user:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Email already registered"
+            )
+        return new_user
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
+
+@app.post("/users")
+async def create_user(user: UserCreate, current_user: dict = Depends(require_admin)):
+    """Create new user (Admin only) - Auto-approved"""
+    password_hash = await aget_password_hash(user.password)
+    return await run_in_threadpool(insert_approved_user, user, password_hash)
 
 @app.put("/users/{user_id}")
 def update_user(user_id: str, user: UserUpdate, current_user: dict = Depends(require_admin)):
@@ -323,13 +549,13 @@ def update_user(user_id: str, user: UserUpdate, current_user: dict = Depends(req
             (user.name, user.role, user_id)
         )
         conn.commit()
+        invalidate_user(user_id)
         updated_user = cursor.fetchone()
         if not updated_user:
             raise HTTPException(status_code=404, detail="User not found")
-        return dict(updated_user)
+        return updated_user
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
 
 @app.delete("/users/{user_id}")
 def delete_user(user_id: str, current_user: dict = Depends(require_admin)):
@@ -378,13 +604,13 @@ def delete_user(user_id: str, current_user: dict = Depends(require_admin)):
             raise HTTPException(status_code=404, detail="User not found")
         
         conn.commit()
+        invalidate_user(user_id)
         message = "User deleted successfully"
         if doc_count > 0:
             message += f" ({doc_count} document(s) reassigned to you)"
         return {"message": message}
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
 
 @app.post("/users/{user_id}/approve")
 def approve_user(user_id: str, current_user: dict = Depends(require_admin)):
@@ -399,13 +625,13 @@ def approve_user(user_id: str, current_user: dict = Depends(require_admin)):
             (user_id,)
         )
         conn.commit()
+        invalidate_user(user_id)
         updated_user = cursor.fetchone()
         if not updated_user:
             raise HTTPException(status_code=404, detail="User not found")
-        return {"message": "User approved successfully", "user": dict(updated_user)}
+        return {"message": "User approved successfully", "user": updated_user}
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
 
 @app.post("/users/{user_id}/disapprove")
 def disapprove_user(user_id: str, current_user: dict = Depends(require_admin)):
@@ -427,27 +653,112 @@ def disapprove_user(user_id: str, current_user: dict = Depends(require_admin)):
             (user_id,)
         )
         conn.commit()
+        invalidate_user(user_id)
         updated_user = cursor.fetchone()
         if not updated_user:
             raise HTTPException(status_code=404, detail="User not found")
-        return {"message": "User disapproved successfully", "user": dict(updated_user)}
+        return {"message": "User disapproved successfully", "user": updated_user}
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
+
+# Warehouses, locations and products change rarely, so their list endpoints
+# are served from Redis (when configured). Any write to one of them drops all
+# three lists, since each embeds names from the others; the TTL bounds
+# staleness if an invalidation is ever missed.
+REFERENCE_CACHE_TTL = 300
+
+def cached_rows(key: str, query: str, params=()):
+    # The encoded JSON is what gets cached, so a hit is sent as-is and a miss
+    # (always the case without Redis) is encoded exactly once
+    body = cache.get_bytes(key)
+    if body is None:
+        body = orjson.dumps(fetch_all(query, params), default=_encode_decimal)
+        cache.set_bytes(key, body, REFERENCE_CACHE_TTL)
+    return Response(body, media_type="application/json")
+
+def invalidate_reference_cache():
+    cache.delete("warehouses:all", "products:all")
+    cache.delete_pattern("locations:*")
+    with _PRODUCT_MATCH_CACHE_LOCK:
+        _PRODUCT_MATCH_CACHE.clear()
+    invalidate_dashboard_cache()
+
+# Low-stock and risk-alert reports read from materialized views (see the
+# add_report_views migration). Anything that changes stock, products or
+# warehouses schedules refresh_report_views as a background task. Refreshes
+# requested while one is running are folded into a single follow-up run.
+_REPORT_REFRESH_LOCK = threading.Lock()
+_REPORT_REFRESH_PENDING = threading.Event()
+
+def refresh_report_views():
+    _REPORT_REFRESH_PENDING.set()
+    while _REPORT_REFRESH_PENDING.is_set() and _REPORT_REFRESH_LOCK.acquire(blocking=False):
+        try:
+            _REPORT_REFRESH_PENDING.clear()
+            conn, cursor = get_db_cursor()
+            try:
+                with conn:
+                    cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_low_stock")
+                    cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_risk_alerts")
+            finally:
+                release_db_cursor(conn, cursor)
+        finally:
+            _REPORT_REFRESH_LOCK.release()
+        invalidate_dashboard_cache()
+
+# Writes trigger a refresh, but mv_risk_alerts' 30-day window is fixed at
+# CURRENT_DATE when it last refreshed; refreshing at startup and on a timer
+# keeps that window moving (and the views current) on a quiet system
+REPORT_REFRESH_INTERVAL = 900
+
+async def refresh_report_views_periodically():
+    while True:
+        try:
+            await run_in_threadpool(refresh_report_views)
+        except Exception:
+            logger.exception("Error refreshing report views")
+        await asyncio.sleep(REPORT_REFRESH_INTERVAL)
+
+@app.on_event("startup")
+async def start_report_refresh():
+    app.state.report_refresh = asyncio.create_task(refresh_report_views_periodically())
+
+@app.on_event("shutdown")
+async def stop_report_refresh():
+    app.state.report_refresh.cancel()
+
+# The dashboard is polled by every open UI, so its two endpoints are cached
+# for a few seconds per process and, when Redis is configured, shared across
+# workers. Writes that change stock, drafts or products drop the entries early.
+DASHBOARD_CACHE_TTL = 10
+_DASHBOARD_CACHE = TTLCache(maxsize=8, ttl=DASHBOARD_CACHE_TTL)
+_DASHBOARD_CACHE_LOCK = threading.Lock()
+_DASHBOARD_KEYS = ("dashboard:summary", "dashboard:risk-alerts")
+
+def cached_dashboard(key: str, load):
+    with _DASHBOARD_CACHE_LOCK:
+        value = _DASHBOARD_CACHE.get(key)
+    if value is None:
+        value = cache.get_json(key)
+        if value is None:
+            value = jsonable_encoder(load())
+            cache.set_json(key, value, DASHBOARD_CACHE_TTL)
+        with _DASHBOARD_CACHE_LOCK:
+            _DASHBOARD_CACHE[key] = value
+    return value
+
+def invalidate_dashboard_cache():
+    with _DASHBOARD_CACHE_LOCK:
+        _DASHBOARD_CACHE.clear()
+    cache.delete(*_DASHBOARD_KEYS)
 
 @app.get("/warehouses")
 def get_warehouses(current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute("SELECT * FROM warehouses ORDER BY name")
-        warehouses = cursor.fetchall()
-        return [dict(w) for w in warehouses]
-    finally:
-        cursor.close()
-        conn.close()
+    return cached_rows("warehouses:all", "SELECT * FROM warehouses ORDER BY name")
 
 @app.post("/warehouses")
-def create_warehouse(warehouse: WarehouseCreate, current_user: dict = Depends(require_admin)):
+def create_warehouse(warehouse: WarehouseCreate, background_tasks: BackgroundTasks,
+                     current_user: dict = Depends(require_admin)):
     conn, cursor = get_db_cursor()
     try:
         cursor.execute(
@@ -455,14 +766,16 @@ def create_warehouse(warehouse: WarehouseCreate, current_user: dict = Depends(re
             (warehouse.name, warehouse.address)
         )
         conn.commit()
+        invalidate_reference_cache()
+        background_tasks.add_task(refresh_report_views)
         result = cursor.fetchone()
-        return dict(result)
+        return result
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
 
 @app.put("/warehouses/{warehouse_id}")
-def update_warehouse(warehouse_id: str, warehouse: WarehouseCreate, current_user: dict = Depends(require_admin)):
+def update_warehouse(warehouse_id: str, warehouse: WarehouseCreate, background_tasks: BackgroundTasks,
+                     current_user: dict = Depends(require_admin)):
     conn, cursor = get_db_cursor()
     try:
         cursor.execute(
@@ -470,42 +783,42 @@ def update_warehouse(warehouse_id: str, warehouse: WarehouseCreate, current_user
             (warehouse.name, warehouse.address, warehouse_id)
         )
         conn.commit()
+        invalidate_reference_cache()
+        background_tasks.add_task(refresh_report_views)
         result = cursor.fetchone()
         if not result:
             raise HTTPException(status_code=404, detail="Warehouse not found")
-        return dict(result)
+        return result
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
 
 @app.delete("/warehouses/{warehouse_id}")
-def delete_warehouse(warehouse_id: str, current_user: dict = Depends(require_admin)):
+def delete_warehouse(warehouse_id: str, background_tasks: BackgroundTasks,
+                     current_user: dict = Depends(require_admin)):
     """Delete warehouse (Admin only)"""
     conn, cursor = get_db_cursor()
     try:
-        # Check if warehouse has locations
-        cursor.execute("SELECT COUNT(*) as count FROM locations WHERE warehouse_id = %s", (warehouse_id,))
-        location_count = cursor.fetchone()
+        # Check if warehouse has locations or stock (both counts in one round trip)
+        cursor.execute(
+            """SELECT
+                   (SELECT COUNT(*) FROM locations WHERE warehouse_id = %(id)s) as location_count,
+                   (SELECT COUNT(*) FROM current_stock cs
+                    JOIN locations l ON cs.location_id = l.id
+                    WHERE l.warehouse_id = %(id)s AND cs.quantity > 0) as stock_count""",
+            {"id": warehouse_id}
+        )
+        counts = cursor.fetchone()
         
-        if location_count and location_count['count'] > 0:
+        if counts['location_count'] > 0:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Cannot delete warehouse. It has {location_count['count']} location(s). Please delete or reassign locations first."
+                detail=f"Cannot delete warehouse. It has {counts['location_count']} location(s). Please delete or reassign locations first."
             )
         
-        # Check if warehouse has stock
-        cursor.execute(
-            """SELECT COUNT(*) as count FROM current_stock cs
-               JOIN locations l ON cs.location_id = l.id
-               WHERE l.warehouse_id = %s AND cs.quantity > 0""",
-            (warehouse_id,)
-        )
-        stock_count = cursor.fetchone()
-        
-        if stock_count and stock_count['count'] > 0:
+        if counts['stock_count'] > 0:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Cannot delete warehouse. It has stock in {stock_count['count']} location(s). Please clear stock first."
+                detail=f"Cannot delete warehouse. It has stock in {counts['stock_count']} location(s). Please clear stock first."
             )
         
         # Delete the warehouse
@@ -516,36 +829,31 @@ def delete_warehouse(warehouse_id: str, current_user: dict = Depends(require_adm
             raise HTTPException(status_code=404, detail="Warehouse not found")
         
         conn.commit()
+        invalidate_reference_cache()
+        background_tasks.add_task(refresh_report_views)
         return {"message": f"Warehouse '{deleted['name']}' deleted successfully"}
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
 
 @app.get("/locations")
 def get_locations(warehouse_id: Optional[str] = None, current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        if warehouse_id:
-            cursor.execute(
-                """SELECT l.*, w.name as warehouse_name
-                   FROM locations l
-                   JOIN warehouses w ON l.warehouse_id = w.id
-                   WHERE l.warehouse_id = %s
-                   ORDER BY l.name""",
-                (warehouse_id,)
-            )
-        else:
-            cursor.execute(
-                """SELECT l.*, w.name as warehouse_name
-                   FROM locations l
-                   JOIN warehouses w ON l.warehouse_id = w.id
-                   ORDER BY w.name, l.name"""
-            )
-        locations = cursor.fetchall()
-        return [dict(loc) for loc in locations]
-    finally:
-        cursor.close()
-        conn.close()
+    if warehouse_id:
+        return cached_rows(
+            f"locations:wh:{warehouse_id}",
+            """SELECT l.*, w.name as warehouse_name
+               FROM locations l
+               JOIN warehouses w ON l.warehouse_id = w.id
+               WHERE l.warehouse_id = %s
+               ORDER BY l.name""",
+            (warehouse_id,)
+        )
+    return cached_rows(
+        "locations:wh:all",
+        """SELECT l.*, w.name as warehouse_name
+           FROM locations l
+           JOIN warehouses w ON l.warehouse_id = w.id
+           ORDER BY w.name, l.name"""
+    )
 
 @app.post("/locations")
 def create_location(location: LocationCreate, current_user: dict = Depends(require_admin)):
@@ -557,11 +865,11 @@ def create_location(location: LocationCreate, current_user: dict = Depends(requi
             (location.warehouse_id, location.name, location.code, location.description)
         )
         conn.commit()
+        invalidate_reference_cache()
         result = cursor.fetchone()
-        return dict(result)
+        return result
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
 
 @app.put("/locations/{location_id}")
 def update_location(location_id: str, location: LocationCreate, current_user: dict = Depends(require_admin)):
@@ -573,48 +881,37 @@ def update_location(location_id: str, location: LocationCreate, current_user: di
             (location.warehouse_id, location.name, location.code, location.description, location_id)
         )
         conn.commit()
+        invalidate_reference_cache()
         result = cursor.fetchone()
         if not result:
             raise HTTPException(status_code=404, detail="Location not found")
-        return dict(result)
+        return result
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
 
 @app.get("/products")
 def get_products(current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute(
-            """SELECT p.*,
-                      w.name as default_warehouse_name,
-                      l.name as default_location_name
-               FROM products p
-               LEFT JOIN warehouses w ON p.default_warehouse_id = w.id
-               LEFT JOIN locations l ON p.default_location_id = l.id
-               ORDER BY p.name"""
-        )
-        products = cursor.fetchall()
-        return [dict(p) for p in products]
-    finally:
-        cursor.close()
-        conn.close()
+    return cached_rows(
+        "products:all",
+        """SELECT p.*,
+                  w.name as default_warehouse_name,
+                  l.name as default_location_name
+           FROM products p
+           LEFT JOIN warehouses w ON p.default_warehouse_id = w.id
+           LEFT JOIN locations l ON p.default_location_id = l.id
+           ORDER BY p.name"""
+    )
 
 @app.get("/products/{product_id}")
 def get_product(product_id: str, current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute("SELECT * FROM products WHERE id = %s", (product_id,))
-        product = cursor.fetchone()
-        if not product:
-            raise HTTPException(status_code=404, detail="Product not found")
-        return dict(product)
-    finally:
-        cursor.close()
-        conn.close()
+    product = fetch_one("SELECT * FROM products WHERE id = %s", (product_id,))
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return product
 
 @app.post("/products")
-def create_product(product: ProductCreate, current_user: dict = Depends(require_admin)):
+def create_product(product: ProductCreate, background_tasks: BackgroundTasks,
+                   current_user: dict = Depends(require_admin)):
     conn, cursor = get_db_cursor()
     try:
         cursor.execute(
@@ -626,14 +923,16 @@ def create_product(product: ProductCreate, current_user: dict = Depends(require_
              product.min_stock, product.opening_stock_qty)
         )
         conn.commit()
+        invalidate_reference_cache()
+        background_tasks.add_task(refresh_report_views)
         result = cursor.fetchone()
-        return dict(result)
+        return result
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
 
 @app.put("/products/{product_id}")
-def update_product(product_id: str, product: ProductCreate, current_user: dict = Depends(require_admin)):
+def update_product(product_id: str, product: ProductCreate, background_tasks: BackgroundTasks,
+                   current_user: dict = Depends(require_admin)):
     conn, cursor = get_db_cursor()
     try:
         cursor.execute(
@@ -647,45 +946,43 @@ def update_product(product_id: str, product: ProductCreate, current_user: dict =
              product.min_stock, product.opening_stock_qty, product_id)
         )
         conn.commit()
+        invalidate_reference_cache()
+        background_tasks.add_task(refresh_report_views)
         result = cursor.fetchone()
         if not result:
             raise HTTPException(status_code=404, detail="Product not found")
-        return dict(result)
+        return result
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
 
 @app.delete("/products/{product_id}")
-def delete_product(product_id: str, current_user: dict = Depends(require_admin)):
+def delete_product(product_id: str, background_tasks: BackgroundTasks,
+                   current_user: dict = Depends(require_admin)):
     """Delete product (Admin only)"""
     conn, cursor = get_db_cursor()
     try:
-        # Check if product has stock
+        # Check if product has stock or is used in any document lines
+        # (both counts in one round trip)
         cursor.execute(
-            """SELECT COUNT(*) as count FROM current_stock 
-               WHERE product_id = %s AND quantity > 0""",
-            (product_id,)
+            """SELECT
+                   (SELECT COUNT(*) FROM current_stock
+                    WHERE product_id = %(id)s AND quantity > 0) as stock_count,
+                   (SELECT COUNT(*) FROM document_lines
+                    WHERE product_id = %(id)s) as line_count""",
+            {"id": product_id}
         )
-        stock_count = cursor.fetchone()
+        counts = cursor.fetchone()
         
-        if stock_count and stock_count['count'] > 0:
+        if counts['stock_count'] > 0:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Cannot delete product. It has stock in {stock_count['count']} location(s). Please clear stock first."
+                detail=f"Cannot delete product. It has stock in {counts['stock_count']} location(s). Please clear stock first."
             )
         
-        # Check if product is used in any document lines
-        cursor.execute(
-            """SELECT COUNT(*) as count FROM document_lines 
-               WHERE product_id = %s""",
-            (product_id,)
-        )
-        doc_count = cursor.fetchone()
-        
-        if doc_count and doc_count['count'] > 0:
+        if counts['line_count'] > 0:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Cannot delete product. It is referenced in {doc_count['count']} document line(s). This product has transaction history."
+                detail=f"Cannot delete product. It is referenced in {counts['line_count']} document line(s). This product has transaction history."
             )
         
         # Delete the product
@@ -696,12 +993,90 @@ def delete_product(product_id: str, current_user: dict = Depends(require_admin))
             raise HTTPException(status_code=404, detail="Product not found")
         
         conn.commit()
+        invalidate_reference_cache()
+        background_tasks.add_task(refresh_report_views)
         return {"message": f"Product '{deleted['name']}' deleted successfully"}
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
+
+# Above this many lines, document lines are loaded with COPY instead of a
+# multi-row INSERT, which skips statement parsing for large imports
+COPY_LINES_THRESHOLD = 500
+
+def insert_document_lines(cursor, doc_id, lines, columns):
+    """Inserts all lines of a document in a single multi-row INSERT.
+
+    columns names the DocumentLineCreate fields to store, e.g.
+    ("product_id", "to_location_id", "quantity").
+    """
+    if not lines:
+        return
+    if len(lines) > COPY_LINES_THRESHOLD:
+        copy_document_lines(cursor, doc_id, lines, columns)
+        return
+    execute_values(
+        cursor,
+        f"INSERT INTO document_lines (document_id, {', '.join(columns)}) VALUES %s",
+        [(doc_id, *(getattr(line, c) for c in columns)) for line in lines],
+        page_size=len(lines)
+    )
+
+def copy_document_lines(cursor, doc_id, lines, columns):
+    # Missing values are written as empty unquoted fields, which CSV COPY reads as NULL
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows((doc_id, *(getattr(line, c) for c in columns)) for line in lines)
+    buffer.seek(0)
+    cursor.copy_expert(
+        f"COPY document_lines (document_id, {', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buffer
+    )
+
+def raise_not_editable(cursor, doc_id, label):
+    """Raises the right error after a guarded UPDATE matched no document.
+
+    Only runs on the error path, so successful updates stay a single statement.
+    """
+    cursor.execute("SELECT 1 FROM documents WHERE id = %s", (doc_id,))
+    if cursor.fetchone() is None:
+        raise HTTPException(status_code=404, detail=f"{label} not found")
+    raise HTTPException(status_code=400, detail="Cannot edit confirmed document")
+
+def lock_document(cursor, doc_id, doc_type):
+    """Reads and row-locks a document header for confirming; None if missing.
+
+    Runs as a prepared statement shared by every doc_type.
+    """
+    execute_prepared(
+        cursor,
+        "lock_document",
+        """SELECT status, warehouse_id, from_warehouse_id, to_warehouse_id, date
+           FROM documents WHERE id = $1 AND doc_type = $2 FOR UPDATE""",
+        (doc_id, doc_type)
+    )
+    return cursor.fetchone()
+
+# Named rather than RETURNING *: a prepared statement's plan stays on its pooled
+# connection, and a * result would break with "cached plan must not change
+# result type" on every warm connection after a documents migration
+_CONFIRMED_DOCUMENT_COLUMNS = (
+    "id, doc_type, status, date, warehouse_id, supplier_name, customer_name, "
+    "from_warehouse_id, to_warehouse_id, reason, created_by_user_id, "
+    "confirmed_by_user_id, created_at, updated_at"
+)
 
-def get_documents_query(doc_type: str, status_filter: Optional[str], warehouse_id: Optional[str]):
+def mark_confirmed(cursor, doc_id, user_id):
+    execute_prepared(
+        cursor,
+        "mark_document_confirmed",
+        f"""UPDATE documents SET status = 'CONFIRMED',
+           confirmed_by_user_id = $1, updated_at = NOW()
+           WHERE id = $2 RETURNING {_CONFIRMED_DOCUMENT_COLUMNS}""",
+        (user_id, doc_id)
+    )
+    return cursor.fetchone()
+
+def get_documents_query(doc_type: str, status_filter: Optional[str], warehouse_id: Optional[str],
+                        limit: Optional[int] = None, offset: int = 0):
     query = f"""
         SELECT d.*,
                u1.name as created_by_name,
@@ -715,972 +1090,531 @@ def get_documents_query(doc_type: str, status_filter: Optional[str], warehouse_i
         LEFT JOIN warehouses w1 ON d.warehouse_id = w1.id
         LEFT JOIN warehouses w2 ON d.from_warehouse_id = w2.id
         LEFT JOIN warehouses w3 ON d.to_warehouse_id = w3.id
-        WHERE d.doc_type = %s
+        WHERE d.doc_type = %(doc_type)s
     """
-    params = [doc_type]
+    params = {"doc_type": doc_type, "warehouse_id": warehouse_id}
 
     if status_filter:
-        query += " AND d.status = %s"
-        params.append(status_filter)
+        query += " AND d.status = %(status)s"
+        params["status"] = status_filter
 
     if warehouse_id:
-        query += " AND (d.warehouse_id = %s OR d.from_warehouse_id = %s OR d.to_warehouse_id = %s)"
-        params.extend([warehouse_id, warehouse_id, warehouse_id])
+        # One indexable branch per warehouse column instead of an OR across
+        # all three; IN collapses documents matched by several branches
+        query += """ AND d.id IN (
+            SELECT id FROM documents WHERE doc_type = %(doc_type)s AND warehouse_id = %(warehouse_id)s
+            UNION ALL
+            SELECT id FROM documents WHERE doc_type = %(doc_type)s AND from_warehouse_id = %(warehouse_id)s
+            UNION ALL
+            SELECT id FROM documents WHERE doc_type = %(doc_type)s AND to_warehouse_id = %(warehouse_id)s
+        )"""
 
     query += " ORDER BY d.date DESC, d.created_at DESC"
+
+    if limit is not None:
+        query += " LIMIT %(limit)s OFFSET %(offset)s"
+        params["limit"] = limit
+        params["offset"] = offset
     return query, params
 
-@app.get("/receipts")
-def get_receipts(status: Optional[str] = None, warehouse_id: Optional[str] = None,
-                 current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        query, params = get_documents_query("RECEIPT", status, warehouse_id)
-        cursor.execute(query, params)
-        docs = cursor.fetchall()
-        return [dict(d) for d in docs]
-    finally:
-        cursor.close()
-        conn.close()
+# The four document kinds share one set of routes and SQL shapes; DOC_SPECS
+# holds what differs between them:
+#   header      document columns copied from DocumentCreate
+#   lines       document_lines columns copied from DocumentLineCreate
+#   warehouses  (document column, alias) of the warehouse names in the detail view
+#   locations   (line column, alias) of the location names on each detail line
+#   sides       how a confirmed line moves stock, as (document warehouse
+#               column, line location column, sign of the quantity)
+DOC_SPECS = {
+    "RECEIPT": {
+        "path": "/receipts",
+        "label": "Receipt",
+        "header": ("warehouse_id", "supplier_name"),
+        "lines": ("product_id", "to_location_id", "quantity"),
+        "warehouses": (("warehouse_id", "warehouse_name"),),
+        "locations": (("to_location_id", "to_location_name"),),
+        "sides": (("warehouse_id", "to_location_id", 1),),
+    },
+    "DELIVERY": {
+        "path": "/deliveries",
+        "label": "Delivery",
+        "header": ("warehouse_id", "customer_name"),
+        "lines": ("product_id", "from_location_id", "quantity"),
+        "warehouses": (("warehouse_id", "warehouse_name"),),
+        "locations": (("from_location_id", "from_location_name"),),
+        "sides": (("warehouse_id", "from_location_id", -1),),
+    },
+    "TRANSFER": {
+        "path": "/transfers",
+        "label": "Transfer",
+        "header": ("from_warehouse_id", "to_warehouse_id"),
+        "lines": ("product_id", "from_location_id", "to_location_id", "quantity"),
+        "warehouses": (("from_warehouse_id", "from_warehouse_name"), ("to_warehouse_id", "to_warehouse_name")),
+        "locations": (("from_location_id", "from_location_name"), ("to_location_id", "to_location_name")),
+        "sides": (("from_warehouse_id", "from_location_id", -1), ("to_warehouse_id", "to_location_id", 1)),
+    },
+    "ADJUSTMENT": {
+        "path": "/adjustments",
+        "label": "Adjustment",
+        "header": ("warehouse_id", "reason"),
+        "lines": ("product_id", "to_location_id", "quantity"),
+        "warehouses": (("warehouse_id", "warehouse_name"),),
+        "locations": (("to_location_id", "location_name"),),
+        "sides": (("warehouse_id", "to_location_id", 1),),
+    },
+}
+
+def json_timestamp(column: str) -> str:
+    """SQL rendering a timestamptz as the ISO string the row encoder produces.
+
+    For JSON built in SQL, where Postgres would otherwise use its own
+    timestamp text. Times are given in UTC.
+    """
+    return f"""to_char({column} AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US"+00:00"')"""
+
+def build_document_sql(doc_type: str, spec: dict) -> dict:
+    """Renders the per-doc_type statements once, at import."""
+    header = spec["header"]
+    warehouse_names = "".join(
+        f"w{i}.name as {alias},\n" for i, (_, alias) in enumerate(spec["warehouses"], 1)
+    )
+    warehouse_joins = "\n".join(
+        f"LEFT JOIN warehouses w{i} ON d.{column} = w{i}.id"
+        for i, (column, _) in enumerate(spec["warehouses"], 1)
+    )
+    location_names = "".join(
+        f", '{alias}', l{i}.name" for i, (_, alias) in enumerate(spec["locations"], 1)
+    )
+    location_joins = "\n".join(
+        f"LEFT JOIN locations l{i} ON dl.{column} = l{i}.id"
+        for i, (column, _) in enumerate(spec["locations"], 1)
+    )
+    # One row per stock side of a line: receipts, deliveries and adjustments
+    # touch a single location, transfers take from one and add to another
+    sides = ",\n".join(
+        f"(%({warehouse})s::uuid, dl.{location}, {'-' if sign < 0 else ''}dl.quantity)"
+        for warehouse, location, sign in spec["sides"]
+    )
+    lateral_sides = f"""FROM document_lines dl
+        CROSS JOIN LATERAL (VALUES {sides}) AS side(warehouse_id, location_id, qty_change)
+        WHERE dl.document_id = %(doc_id)s"""
 
-@app.get("/receipts/{doc_id}")
-def get_receipt(doc_id: str, current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute(
-            """SELECT d.*,
-                      w.name as warehouse_name
-               FROM documents d
-               LEFT JOIN warehouses w ON d.warehouse_id = w.id
-               WHERE d.id = %s AND d.doc_type = 'RECEIPT'""",
-            (doc_id,)
-        )
-        doc = cursor.fetchone()
-        if not doc:
-            raise HTTPException(status_code=404, detail="Receipt not found")
+    return {
+        # Header and lines in one round trip: the lines come back as a JSON
+        # array built by a correlated subquery. A document's lines share one
+        # created_at (they are inserted in one transaction), so ctid, their
+        # physical order, keeps them in insertion order.
+        "detail": f"""SELECT d.*,
+                  {warehouse_names}COALESCE((
+                      SELECT json_agg(
+                                 json_build_object(
+                                     'id', dl.id,
+                                     'document_id', dl.document_id,
+                                     'product_id', dl.product_id,
+                                     'from_location_id', dl.from_location_id,
+                                     'to_location_id', dl.to_location_id,
+                                     'quantity', dl.quantity,
+                                     'created_at', {json_timestamp("dl.created_at")},
+                                     'product_name', p.name,
+                                     'product_sku', p.sku{location_names}
+                                 ) ORDER BY dl.created_at, dl.ctid
+                             )
+                      FROM document_lines dl
+                      JOIN products p ON dl.product_id = p.id
+                      {location_joins}
+                      WHERE dl.document_id = d.id
+                  ), '[]'::json) as lines
+           FROM documents d
+           {warehouse_joins}
+           WHERE d.id = %s AND d.doc_type = '{doc_type}'""",
+        "create": f"""INSERT INTO documents
+                   (doc_type, status, date, {', '.join(header)}, created_by_user_id)
+                   VALUES ('{doc_type}', 'DRAFT', %s, {', '.join(['%s'] * len(header))}, %s)
+                   RETURNING *""",
+        # Guarded by status so a confirmed document is never changed; see
+        # raise_not_editable for the error path
+        "update": f"""UPDATE documents SET
+                   date = %s, {', '.join(f'{c} = %s' for c in header)}, updated_at = NOW()
+                   WHERE id = %s AND status <> 'CONFIRMED' RETURNING *""",
+        "movements": f"""INSERT INTO stock_movements
+                   (product_id, warehouse_id, location_id, document_id, document_line_id,
+                    movement_date, qty_change)
+                   SELECT dl.product_id, side.warehouse_id, side.location_id, dl.document_id, dl.id,
+                          %(date)s, side.qty_change
+                   {lateral_sides}""",
+        # Sides are summed per location first: ON CONFLICT cannot touch the
+        # same current_stock row twice in one statement
+        "stock": f"""INSERT INTO current_stock (product_id, warehouse_id, location_id, quantity)
+                   SELECT dl.product_id, side.warehouse_id, side.location_id, SUM(side.qty_change)
+                   {lateral_sides}
+                   GROUP BY dl.product_id, side.warehouse_id, side.location_id
+                   ON CONFLICT (product_id, warehouse_id, location_id)
+                   DO UPDATE SET quantity = current_stock.quantity + EXCLUDED.quantity,
+                                 updated_at = NOW()""",
+    }
 
-        cursor.execute(
-            """SELECT dl.*,
-                      p.name as product_name, p.sku as product_sku,
-                      l.name as to_location_name
-               FROM document_lines dl
-               JOIN products p ON dl.product_id = p.id
-               LEFT JOIN locations l ON dl.to_location_id = l.id
-               WHERE dl.document_id = %s""",
-            (doc_id,)
-        )
-        lines = cursor.fetchall()
+def register_document_routes(doc_type: str, spec: dict):
+    """Adds the list, detail, create, update and confirm routes for one doc_type."""
+    path, label = spec["path"], spec["label"]
+    header, line_columns = spec["header"], spec["lines"]
+    sql = build_document_sql(doc_type, spec)
+    name = label.lower()
 
-        result = dict(doc)
-        result["lines"] = [dict(line) for line in lines]
-        return result
-    finally:
-        cursor.close()
-        conn.close()
+    def list_documents(status: Optional[str] = None, warehouse_id: Optional[str] = None,
+                       limit: Optional[int] = Query(None, ge=1, le=500), offset: int = Query(0, ge=0),
+                       current_user: dict = Depends(get_current_user)):
+        return RowsResponse(fetch_all(*get_documents_query(doc_type, status, warehouse_id, limit, offset)))
 
-@app.post("/receipts")
-def create_receipt(doc: DocumentCreate, current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute(
-            """INSERT INTO documents
-               (doc_type, status, date, warehouse_id, supplier_name, created_by_user_id)
-               VALUES ('RECEIPT', 'DRAFT', %s, %s, %s, %s) RETURNING *""",
-            (doc.date, doc.warehouse_id, doc.supplier_name, current_user["id"])
-        )
-        document = cursor.fetchone()
-        doc_id = document["id"]
+    def get_document(doc_id: str, current_user: dict = Depends(get_current_user)):
+        doc = fetch_one(sql["detail"], (doc_id,))
+        if not doc:
+            raise HTTPException(status_code=404, detail=f"{label} not found")
+        return RowsResponse(doc)
 
-        for line in doc.lines:
-            cursor.execute(
-                """INSERT INTO document_lines
-                   (document_id, product_id, to_location_id, quantity)
-                   VALUES (%s, %s, %s, %s)""",
-                (doc_id, line.product_id, line.to_location_id, line.quantity)
-            )
+    def create_document(doc: DocumentCreate, current_user: dict = Depends(get_current_user)):
+        conn, cursor = get_db_cursor()
+        try:
+            with conn:
+                cursor.execute(
+                    sql["create"],
+                    (doc.date, *(getattr(doc, c) for c in header), current_user["id"])
+                )
+                document = cursor.fetchone()
+                insert_document_lines(cursor, document["id"], doc.lines, line_columns)
+            invalidate_dashboard_cache()
+            return document
+        finally:
+            release_db_cursor(conn, cursor)
 
-        conn.commit()
-        return dict(document)
-    finally:
-        cursor.close()
-        conn.close()
+    def update_document(doc_id: str, doc: DocumentCreate, current_user: dict = Depends(get_current_user)):
+        conn, cursor = get_db_cursor()
+        try:
+            with conn:
+                cursor.execute(sql["update"], (doc.date, *(getattr(doc, c) for c in header), doc_id))
+                document = cursor.fetchone()
+                if document is None:
+                    raise_not_editable(cursor, doc_id, label)
+
+                cursor.execute("DELETE FROM document_lines WHERE document_id = %s", (doc_id,))
+                insert_document_lines(cursor, doc_id, doc.lines, line_columns)
+            return document
+        finally:
+            release_db_cursor(conn, cursor)
 
-@app.put("/receipts/{doc_id}")
-def update_receipt(doc_id: str, doc: DocumentCreate, current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute("SELECT status FROM documents WHERE id = %s", (doc_id,))
-        existing = cursor.fetchone()
-        if not existing:
-            raise HTTPException(status_code=404, detail="Receipt not found")
-        if existing["status"] == "CONFIRMED":
-            raise HTTPException(status_code=400, detail="Cannot edit confirmed document")
+    def confirm_document(doc_id: str, background_tasks: BackgroundTasks,
+                         current_user: dict = Depends(require_admin)):
+        conn, cursor = get_db_cursor()
+        try:
+            with conn:
+                # Row lock serializes concurrent confirms of the same document
+                doc = lock_document(cursor, doc_id, doc_type)
+                if not doc:
+                    raise HTTPException(status_code=404, detail=f"{label} not found")
+                if doc["status"] == "CONFIRMED":
+                    raise HTTPException(status_code=400, detail="Already confirmed")
+
+                params = {**doc, "doc_id": doc_id}
+                cursor.execute(sql["movements"], params)
+                cursor.execute(sql["stock"], params)
+                result = mark_confirmed(cursor, doc_id, current_user["id"])
+            invalidate_dashboard_cache()
+            background_tasks.add_task(refresh_report_views)
+            return result
+        finally:
+            release_db_cursor(conn, cursor)
 
-        cursor.execute(
-            """UPDATE documents SET
-               date = %s, warehouse_id = %s, supplier_name = %s, updated_at = NOW()
-               WHERE id = %s RETURNING *""",
-            (doc.date, doc.warehouse_id, doc.supplier_name, doc_id)
-        )
+    app.add_api_route(path, list_documents, methods=["GET"], name=f"get_{path.strip('/')}")
+    app.add_api_route(f"{path}/{{doc_id}}", get_document, methods=["GET"], name=f"get_{name}")
+    app.add_api_route(path, create_document, methods=["POST"], name=f"create_{name}")
+    app.add_api_route(f"{path}/{{doc_id}}", update_document, methods=["PUT"], name=f"update_{name}")
+    app.add_api_route(f"{path}/{{doc_id}}/confirm", confirm_document, methods=["POST"], name=f"confirm_{name}")
 
-        cursor.execute("DELETE FROM document_lines WHERE document_id = %s", (doc_id,))
+for _doc_type, _spec in DOC_SPECS.items():
+    register_document_routes(_doc_type, _spec)
 
-        for line in doc.lines:
-            cursor.execute(
-                """INSERT INTO document_lines
-                   (document_id, product_id, to_location_id, quantity)
-                   VALUES (%s, %s, %s, %s)""",
-                (doc_id, line.product_id, line.to_location_id, line.quantity)
-            )
+def compile_filtered_queries(base: str, filters, order_by: str, page: str) -> dict:
+    """Renders a query once for every combination of its optional filters.
 
-        conn.commit()
-        document = cursor.fetchone()
-        return dict(document)
-    finally:
-        cursor.close()
-        conn.close()
-
-@app.post("/receipts/{doc_id}/confirm")
-def confirm_receipt(doc_id: str, current_user: dict = Depends(require_admin)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute(
-            "SELECT * FROM documents WHERE id = %s AND doc_type = 'RECEIPT'",
-            (doc_id,)
-        )
-        doc = cursor.fetchone()
-        if not doc:
-            raise HTTPException(status_code=404, detail="Receipt not found")
-        if doc["status"] == "CONFIRMED":
-            raise HTTPException(status_code=400, detail="Already confirmed")
-
-        cursor.execute(
-            "SELECT * FROM document_lines WHERE document_id = %s",
-            (doc_id,)
-        )
-        lines = cursor.fetchall()
-
-        for line in lines:
-            cursor.execute(
-                """INSERT INTO stock_movements
-                   (product_id, warehouse_id, location_id, document_id, document_line_id,
-                    movement_date, qty_change)
-                   VALUES (%s, %s, %s, %s, %s, %s, %s)""",
-                (line["product_id"], doc["warehouse_id"], line["to_location_id"],
-                 doc_id, line["id"], doc["date"], line["quantity"])
-            )
-
-            cursor.execute(
-                """INSERT INTO current_stock (product_id, warehouse_id, location_id, quantity)
-                   VALUES (%s, %s, %s, %s)
-                   ON CONFLICT (product_id, warehouse_id, location_id)
-                   DO UPDATE SET quantity = current_stock.quantity + EXCLUDED.quantity,
-                                 updated_at = NOW()""",
-                (line["product_id"], doc["warehouse_id"], line["to_location_id"], line["quantity"])
-            )
-
-        cursor.execute(
-            """UPDATE documents SET status = 'CONFIRMED',
-               confirmed_by_user_id = %s, updated_at = NOW()
-               WHERE id = %s RETURNING *""",
-            (current_user["id"], doc_id)
-        )
-
-        conn.commit()
-        result = cursor.fetchone()
-        return dict(result)
-    finally:
-        cursor.close()
-        conn.close()
-
-@app.get("/deliveries")
-def get_deliveries(status: Optional[str] = None, warehouse_id: Optional[str] = None,
-                   current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        query, params = get_documents_query("DELIVERY", status, warehouse_id)
-        cursor.execute(query, params)
-        docs = cursor.fetchall()
-        return [dict(d) for d in docs]
-    finally:
-        cursor.close()
-        conn.close()
-
-@app.get("/deliveries/{doc_id}")
-def get_delivery(doc_id: str, current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute(
-            """SELECT d.*, w.name as warehouse_name
-               FROM documents d
-               LEFT JOIN warehouses w ON d.warehouse_id = w.id
-               WHERE d.id = %s AND d.doc_type = 'DELIVERY'""",
-            (doc_id,)
-        )
-        doc = cursor.fetchone()
-        if not doc:
-            raise HTTPException(status_code=404, detail="Delivery not found")
-
-        cursor.execute(
-            """SELECT dl.*,
-                      p.name as product_name, p.sku as product_sku,
-                      l.name as from_location_name
-               FROM document_lines dl
-               JOIN products p ON dl.product_id = p.id
-               LEFT JOIN locations l ON dl.from_location_id = l.id
-               WHERE dl.document_id = %s""",
-            (doc_id,)
-        )
-        lines = cursor.fetchall()
-
-        result = dict(doc)
-        result["lines"] = [dict(line) for line in lines]
-        return result
-    finally:
-        cursor.close()
-        conn.close()
-
-@app.post("/deliveries")
-def create_delivery(doc: DocumentCreate, current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute(
-            """INSERT INTO documents
-               (doc_type, status, date, warehouse_id, customer_name, created_by_user_id)
-               VALUES ('DELIVERY', 'DRAFT', %s, %s, %s, %s) RETURNING *""",
-            (doc.date, doc.warehouse_id, doc.customer_name, current_user["id"])
-        )
-        document = cursor.fetchone()
-        doc_id = document["id"]
-
-        for line in doc.lines:
-            cursor.execute(
-                """INSERT INTO document_lines
-                   (document_id, product_id, from_location_id, quantity)
-                   VALUES (%s, %s, %s, %s)""",
-                (doc_id, line.product_id, line.from_location_id, line.quantity)
-            )
-
-        conn.commit()
-        return dict(document)
-    finally:
-        cursor.close()
-        conn.close()
-
-@app.put("/deliveries/{doc_id}")
-def update_delivery(doc_id: str, doc: DocumentCreate, current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute("SELECT status FROM documents WHERE id = %s", (doc_id,))
-        existing = cursor.fetchone()
-        if not existing:
-            raise HTTPException(status_code=404, detail="Delivery not found")
-        if existing["status"] == "CONFIRMED":
-            raise HTTPException(status_code=400, detail="Cannot edit confirmed document")
-
-        cursor.execute(
-            """UPDATE documents SET
-               date = %s, warehouse_id = %s, customer_name = %s, updated_at = NOW()
-               WHERE id = %s RETURNING *""",
-            (doc.date, doc.warehouse_id, doc.customer_name, doc_id)
-        )
-
-        cursor.execute("DELETE FROM document_lines WHERE document_id = %s", (doc_id,))
-
-        for line in doc.lines:
-            cursor.execute(
-                """INSERT INTO document_lines
-                   (document_id, product_id, from_location_id, quantity)
-                   VALUES (%s, %s, %s, %s)""",
-                (doc_id, line.product_id, line.from_location_id, line.quantity)
-            )
-
-        conn.commit()
-        document = cursor.fetchone()
-        return dict(document)
-    finally:
-        cursor.close()
-        conn.close()
-
-@app.post("/deliveries/{doc_id}/confirm")
-def confirm_delivery(doc_id: str, current_user: dict = Depends(require_admin)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute(
-            "SELECT * FROM documents WHERE id = %s AND doc_type = 'DELIVERY'",
-            (doc_id,)
-        )
-        doc = cursor.fetchone()
-        if not doc:
-            raise HTTPException(status_code=404, detail="Delivery not found")
-        if doc["status"] == "CONFIRMED":
-            raise HTTPException(status_code=400, detail="Already confirmed")
-
-        cursor.execute(
-            "SELECT * FROM document_lines WHERE document_id = %s",
-            (doc_id,)
-        )
-        lines = cursor.fetchall()
-
-        for line in lines:
-            cursor.execute(
-                """INSERT INTO stock_movements
-                   (product_id, warehouse_id, location_id, document_id, document_line_id,
-                    movement_date, qty_change)
-                   VALUES (%s, %s, %s, %s, %s, %s, %s)""",
-                (line["product_id"], doc["warehouse_id"], line["from_location_id"],
-                 doc_id, line["id"], doc["date"], -line["quantity"])
-            )
-
-            cursor.execute(
-                """INSERT INTO current_stock (product_id, warehouse_id, location_id, quantity)
-                   VALUES (%s, %s, %s, %s)
-                   ON CONFLICT (product_id, warehouse_id, location_id)
-                   DO UPDATE SET quantity = current_stock.quantity + EXCLUDED.quantity,
-                                 updated_at = NOW()""",
-                (line["product_id"], doc["warehouse_id"], line["from_location_id"], -line["quantity"])
-            )
-
-        cursor.execute(
-            """UPDATE documents SET status = 'CONFIRMED',
-               confirmed_by_user_id = %s, updated_at = NOW()
-               WHERE id = %s RETURNING *""",
-            (current_user["id"], doc_id)
-        )
-
-        conn.commit()
-        result = cursor.fetchone()
-        return dict(result)
-    finally:
-        cursor.close()
-        conn.close()
-
-@app.get("/transfers")
-def get_transfers(status: Optional[str] = None, warehouse_id: Optional[str] = None,
-                  current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        query, params = get_documents_query("TRANSFER", status, warehouse_id)
-        cursor.execute(query, params)
-        docs = cursor.fetchall()
-        return [dict(d) for d in docs]
-    finally:
-        cursor.close()
-        conn.close()
-
-@app.get("/transfers/{doc_id}")
-def get_transfer(doc_id: str, current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute(
-            """SELECT d.*,
-                      w1.name as from_warehouse_name,
-                      w2.name as to_warehouse_name
-               FROM documents d
-               LEFT JOIN warehouses w1 ON d.from_warehouse_id = w1.id
-               LEFT JOIN warehouses w2 ON d.to_warehouse_id = w2.id
-               WHERE d.id = %s AND d.doc_type = 'TRANSFER'""",
-            (doc_id,)
-        )
-        doc = cursor.fetchone()
-        if not doc:
-            raise HTTPException(status_code=404, detail="Transfer not found")
-
-        cursor.execute(
-            """SELECT dl.*,
-                      p.name as product_name, p.sku as product_sku,
-                      l1.name as from_location_name,
-                      l2.name as to_location_name
-               FROM document_lines dl
-               JOIN products p ON dl.product_id = p.id
-               LEFT JOIN locations l1 ON dl.from_location_id = l1.id
-               LEFT JOIN locations l2 ON dl.to_location_id = l2.id
-               WHERE dl.document_id = %s""",
-            (doc_id,)
-        )
-        lines = cursor.fetchall()
-
-        result = dict(doc)
-        result["lines"] = [dict(line) for line in lines]
-        return result
-    finally:
-        cursor.close()
-        conn.close()
-
-@app.post("/transfers")
-def create_transfer(doc: DocumentCreate, current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute(
-            """INSERT INTO documents
-               (doc_type, status, date, from_warehouse_id, to_warehouse_id, created_by_user_id)
-               VALUES ('TRANSFER', 'DRAFT', %s, %s, %s, %s) RETURNING *""",
-            (doc.date, doc.from_warehouse_id, doc.to_warehouse_id, current_user["id"])
-        )
-        document = cursor.fetchone()
-        doc_id = document["id"]
-
-        for line in doc.lines:
-            cursor.execute(
-                """INSERT INTO document_lines
-                   (document_id, product_id, from_location_id, to_location_id, quantity)
-                   VALUES (%s, %s, %s, %s, %s)""",
-                (doc_id, line.product_id, line.from_location_id, line.to_location_id, line.quantity)
-            )
-
-        conn.commit()
-        return dict(document)
-    finally:
-        cursor.close()
-        conn.close()
-
-@app.put("/transfers/{doc_id}")
-def update_transfer(doc_id: str, doc: DocumentCreate, current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute("SELECT status FROM documents WHERE id = %s", (doc_id,))
-        existing = cursor.fetchone()
-        if not existing:
-            raise HTTPException(status_code=404, detail="Transfer not found")
-        if existing["status"] == "CONFIRMED":
-            raise HTTPException(status_code=400, detail="Cannot edit confirmed document")
-
-        cursor.execute(
-            """UPDATE documents SET
-               date = %s, from_warehouse_id = %s, to_warehouse_id = %s, updated_at = NOW()
-               WHERE id = %s RETURNING *""",
-            (doc.date, doc.from_warehouse_id, doc.to_warehouse_id, doc_id)
-        )
-
-        cursor.execute("DELETE FROM document_lines WHERE document_id = %s", (doc_id,))
-
-        for line in doc.lines:
-            cursor.execute(
-                """INSERT INTO document_lines
-                   (document_id, product_id, from_location_id, to_location_id, quantity)
-                   VALUES (%s, %s, %s, %s, %s)""",
-                (doc_id, line.product_id, line.from_location_id, line.to_location_id, line.quantity)
-            )
-
-        conn.commit()
-        document = cursor.fetchone()
-        return dict(document)
-    finally:
-        cursor.close()
-        conn.close()
-
-@app.post("/transfers/{doc_id}/confirm")
-def confirm_transfer(doc_id: str, current_user: dict = Depends(require_admin)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute(
-            "SELECT * FROM documents WHERE id = %s AND doc_type = 'TRANSFER'",
-            (doc_id,)
-        )
-        doc = cursor.fetchone()
-        if not doc:
-            raise HTTPException(status_code=404, detail="Transfer not found")
-        if doc["status"] == "CONFIRMED":
-            raise HTTPException(status_code=400, detail="Already confirmed")
-
-        cursor.execute(
-            "SELECT * FROM document_lines WHERE document_id = %s",
-            (doc_id,)
-        )
-        lines = cursor.fetchall()
-
-        for line in lines:
-            cursor.execute(
-                """INSERT INTO stock_movements
-                   (product_id, warehouse_id, location_id, document_id, document_line_id,
-                    movement_date, qty_change)
-                   VALUES (%s, %s, %s, %s, %s, %s, %s)""",
-                (line["product_id"], doc["from_warehouse_id"], line["from_location_id"],
-                 doc_id, line["id"], doc["date"], -line["quantity"])
-            )
-
-            cursor.execute(
-                """INSERT INTO current_stock (product_id, warehouse_id, location_id, quantity)
-                   VALUES (%s, %s, %s, %s)
-                   ON CONFLICT (product_id, warehouse_id, location_id)
-                   DO UPDATE SET quantity = current_stock.quantity + EXCLUDED.quantity,
-                                 updated_at = NOW()""",
-                (line["product_id"], doc["from_warehouse_id"], line["from_location_id"], -line["quantity"])
-            )
-
-            cursor.execute(
-                """INSERT INTO stock_movements
-                   (product_id, warehouse_id, location_id, document_id, document_line_id,
-                    movement_date, qty_change)
-                   VALUES (%s, %s, %s, %s, %s, %s, %s)""",
-                (line["product_id"], doc["to_warehouse_id"], line["to_location_id"],
-                 doc_id, line["id"], doc["date"], line["quantity"])
-            )
-
-            cursor.execute(
-                """INSERT INTO current_stock (product_id, warehouse_id, location_id, quantity)
-                   VALUES (%s, %s, %s, %s)
-                   ON CONFLICT (product_id, warehouse_id, location_id)
-                   DO UPDATE SET quantity = current_stock.quantity + EXCLUDED.quantity,
-                                 updated_at = NOW()""",
-                (line["product_id"], doc["to_warehouse_id"], line["to_location_id"], line["quantity"])
-            )
-
-        cursor.execute(
-            """UPDATE documents SET status = 'CONFIRMED',
-               confirmed_by_user_id = %s, updated_at = NOW()
-               WHERE id = %s RETURNING *""",
-            (current_user["id"], doc_id)
-        )
-
-        conn.commit()
-        result = cursor.fetchone()
-        return dict(result)
-    finally:
-        cursor.close()
-        conn.close()
-
-@app.get("/adjustments")
-def get_adjustments(status: Optional[str] = None, warehouse_id: Optional[str] = None,
-                    current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        query, params = get_documents_query("ADJUSTMENT", status, warehouse_id)
-        cursor.execute(query, params)
-        docs = cursor.fetchall()
-        return [dict(d) for d in docs]
-    finally:
-        cursor.close()
-        conn.close()
-
-@app.get("/adjustments/{doc_id}")
-def get_adjustment(doc_id: str, current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute(
-            """SELECT d.*, w.name as warehouse_name
-               FROM documents d
-               LEFT JOIN warehouses w ON d.warehouse_id = w.id
-               WHERE d.id = %s AND d.doc_type = 'ADJUSTMENT'""",
-            (doc_id,)
-        )
-        doc = cursor.fetchone()
-        if not doc:
-            raise HTTPException(status_code=404, detail="Adjustment not found")
-
-        cursor.execute(
-            """SELECT dl.*,
-                      p.name as product_name, p.sku as product_sku,
-                      l.name as location_name
-               FROM document_lines dl
-               JOIN products p ON dl.product_id = p.id
-               LEFT JOIN locations l ON dl.to_location_id = l.id
-               WHERE dl.document_id = %s""",
-            (doc_id,)
-        )
-        lines = cursor.fetchall()
-
-        result = dict(doc)
-        result["lines"] = [dict(line) for line in lines]
-        return result
-    finally:
-        cursor.close()
-        conn.close()
-
-@app.post("/adjustments")
-def create_adjustment(doc: DocumentCreate, current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute(
-            """INSERT INTO documents
-               (doc_type, status, date, warehouse_id, reason, created_by_user_id)
-               VALUES ('ADJUSTMENT', 'DRAFT', %s, %s, %s, %s) RETURNING *""",
-            (doc.date, doc.warehouse_id, doc.reason, current_user["id"])
-        )
-        document = cursor.fetchone()
-        doc_id = document["id"]
-
-        for line in doc.lines:
-            cursor.execute(
-                """INSERT INTO document_lines
-                   (document_id, product_id, to_location_id, quantity)
-                   VALUES (%s, %s, %s, %s)""",
-                (doc_id, line.product_id, line.to_location_id, line.quantity)
-            )
-
-        conn.commit()
-        return dict(document)
-    finally:
-        cursor.close()
-        conn.close()
-
-@app.put("/adjustments/{doc_id}")
-def update_adjustment(doc_id: str, doc: DocumentCreate, current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute("SELECT status FROM documents WHERE id = %s", (doc_id,))
-        existing = cursor.fetchone()
-        if not existing:
-            raise HTTPException(status_code=404, detail="Adjustment not found")
-        if existing["status"] == "CONFIRMED":
-            raise HTTPException(status_code=400, detail="Cannot edit confirmed document")
-
-        cursor.execute(
-            """UPDATE documents SET
-               date = %s, warehouse_id = %s, reason = %s, updated_at = NOW()
-               WHERE id = %s RETURNING *""",
-            (doc.date, doc.warehouse_id, doc.reason, doc_id)
-        )
-
-        cursor.execute("DELETE FROM document_lines WHERE document_id = %s", (doc_id,))
-
-        for line in doc.lines:
-            cursor.execute(
-                """INSERT INTO document_lines
-                   (document_id, product_id, to_location_id, quantity)
-                   VALUES (%s, %s, %s, %s)""",
-                (doc_id, line.product_id, line.to_location_id, line.quantity)
-            )
-
-        conn.commit()
-        document = cursor.fetchone()
-        return dict(document)
-    finally:
-        cursor.close()
-        conn.close()
-
-@app.post("/adjustments/{doc_id}/confirm")
-def confirm_adjustment(doc_id: str, current_user: dict = Depends(require_admin)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute(
-            "SELECT * FROM documents WHERE id = %s AND doc_type = 'ADJUSTMENT'",
-            (doc_id,)
-        )
-        doc = cursor.fetchone()
-        if not doc:
-            raise HTTPException(status_code=404, detail="Adjustment not found")
-        if doc["status"] == "CONFIRMED":
-            raise HTTPException(status_code=400, detail="Already confirmed")
-
-        cursor.execute(
-            "SELECT * FROM document_lines WHERE document_id = %s",
-            (doc_id,)
-        )
-        lines = cursor.fetchall()
-
-        for line in lines:
-            cursor.execute(
-                """INSERT INTO stock_movements
-                   (product_id, warehouse_id, location_id, document_id, document_line_id,
-                    movement_date, qty_change)
-                   VALUES (%s, %s, %s, %s, %s, %s, %s)""",
-                (line["product_id"], doc["warehouse_id"], line["to_location_id"],
-                 doc_id, line["id"], doc["date"], line["quantity"])
-            )
-
-            cursor.execute(
-                """INSERT INTO current_stock (product_id, warehouse_id, location_id, quantity)
-                   VALUES (%s, %s, %s, %s)
-                   ON CONFLICT (product_id, warehouse_id, location_id)
-                   DO UPDATE SET quantity = current_stock.quantity + EXCLUDED.quantity,
-                                 updated_at = NOW()""",
-                (line["product_id"], doc["warehouse_id"], line["to_location_id"], line["quantity"])
-            )
-
-        cursor.execute(
-            """UPDATE documents SET status = 'CONFIRMED',
-               confirmed_by_user_id = %s, updated_at = NOW()
-               WHERE id = %s RETURNING *""",
-            (current_user["id"], doc_id)
-        )
-
-        conn.commit()
-        result = cursor.fetchone()
-        return dict(result)
-    finally:
-        cursor.close()
-        conn.close()
+    filters is a sequence of (name, condition) pairs ANDed onto base. The
+    result is keyed by (names of the active filters, paged), so handlers pick
+    a ready string instead of concatenating one per request, and each
+    variant keeps the same SQL text for the server's plan cache.
+    """
+    queries = {}
+    for mask in itertools.product((False, True), repeat=len(filters)):
+        active = tuple(name for (name, _), on in zip(filters, mask) if on)
+        where = "".join(f" AND {condition}" for (_, condition), on in zip(filters, mask) if on)
+        queries[active, False] = f"{base}{where} {order_by}"
+        queries[active, True] = f"{base}{where} {order_by} {page}"
+    return queries
+
+def filtered_query(queries: dict, filters, values: dict, page_params=None):
+    """Returns (query, params) for the filters whose value is set.
+
+    A filter whose condition takes several parameters gets a tuple value.
+    page_params, when given, selects the paged variant and is appended.
+    """
+    active = tuple(name for name, _ in filters if values[name])
+    params = []
+    for name in active:
+        value = values[name]
+        params.extend(value if isinstance(value, tuple) else (value,))
+    if page_params is not None:
+        params.extend(page_params)
+    return queries[active, page_params is not None], params
+
+_STOCK_FILTERS = (
+    ("product_id", "cs.product_id = %s"),
+    ("warehouse_id", "cs.warehouse_id = %s"),
+    ("location_id", "cs.location_id = %s"),
+    ("category", "p.category = %s"),
+)
+_STOCK_QUERIES = compile_filtered_queries(
+    """SELECT cs.*,
+              p.name as product_name, p.sku as product_sku, p.category,
+              w.name as warehouse_name,
+              l.name as location_name
+       FROM current_stock cs
+       JOIN products p ON cs.product_id = p.id
+       JOIN warehouses w ON cs.warehouse_id = w.id
+       JOIN locations l ON cs.location_id = l.id
+       WHERE TRUE""",
+    _STOCK_FILTERS,
+    "ORDER BY p.name, w.name, l.name",
+    "LIMIT %s OFFSET %s",
+)
 
 @app.get("/stock")
 def get_stock(product_id: Optional[str] = None, warehouse_id: Optional[str] = None,
               location_id: Optional[str] = None, category: Optional[str] = None,
+              limit: Optional[int] = Query(None, ge=1, le=1000), offset: int = Query(0, ge=0),
               current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        query = """
-            SELECT cs.*,
-                   p.name as product_name, p.sku as product_sku, p.category,
-                   w.name as warehouse_name,
-                   l.name as location_name
-            FROM current_stock cs
-            JOIN products p ON cs.product_id = p.id
-            JOIN warehouses w ON cs.warehouse_id = w.id
-            JOIN locations l ON cs.location_id = l.id
-            WHERE 1=1
-        """
-        params = []
-
-        if product_id:
-            query += " AND cs.product_id = %s"
-            params.append(product_id)
-
-        if warehouse_id:
-            query += " AND cs.warehouse_id = %s"
-            params.append(warehouse_id)
-
-        if location_id:
-            query += " AND cs.location_id = %s"
-            params.append(location_id)
-
-        if category:
-            query += " AND p.category = %s"
-            params.append(category)
-
-        query += " ORDER BY p.name, w.name, l.name"
-
-        cursor.execute(query, params)
-        stock = cursor.fetchall()
-        return [dict(s) for s in stock]
-    finally:
-        cursor.close()
-        conn.close()
+    query, params = filtered_query(
+        _STOCK_QUERIES,
+        _STOCK_FILTERS,
+        {"product_id": product_id, "warehouse_id": warehouse_id,
+         "location_id": location_id, "category": category},
+        (limit, offset) if limit is not None else None,
+    )
+    # A page is at most 1000 rows: read it in one go and free the connection
+    if limit is not None:
+        return RowsResponse(fetch_all(query, params))
+    return stream_rows(query, params)
+
+_MOVEMENT_FILTERS = (
+    ("product_id", "sm.product_id = %s"),
+    ("warehouse_id", "sm.warehouse_id = %s"),
+    ("doc_type", "d.doc_type = %s"),
+    ("date_from", "sm.movement_date >= %s"),
+    ("date_to", "sm.movement_date <= %s"),
+    ("before", "(sm.movement_date, sm.created_at, sm.id) < (%s, %s, %s::uuid)"),
+)
+_MOVEMENT_QUERIES = compile_filtered_queries(
+    """SELECT sm.*,
+              p.name as product_name, p.sku as product_sku,
+              w.name as warehouse_name,
+              l.name as location_name,
+              d.doc_type, d.status
+       FROM stock_movements sm
+       JOIN products p ON sm.product_id = p.id
+       JOIN warehouses w ON sm.warehouse_id = w.id
+       JOIN locations l ON sm.location_id = l.id
+       JOIN documents d ON sm.document_id = d.id
+       WHERE TRUE""",
+    _MOVEMENT_FILTERS,
+    "ORDER BY sm.movement_date DESC, sm.created_at DESC, sm.id DESC",
+    "LIMIT %s",
+)
 
 @app.get("/movements")
 def get_movements(product_id: Optional[str] = None, warehouse_id: Optional[str] = None,
                   doc_type: Optional[str] = None, date_from: Optional[str] = None,
-                  date_to: Optional[str] = None, current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        query = """
-            SELECT sm.*,
-                   p.name as product_name, p.sku as product_sku,
-                   w.name as warehouse_name,
-                   l.name as location_name,
-                   d.doc_type, d.status
-            FROM stock_movements sm
-            JOIN products p ON sm.product_id = p.id
-            JOIN warehouses w ON sm.warehouse_id = w.id
-            JOIN locations l ON sm.location_id = l.id
-            JOIN documents d ON sm.document_id = d.id
-            WHERE 1=1
-        """
-        params = []
-
-        if product_id:
-            query += " AND sm.product_id = %s"
-            params.append(product_id)
-
-        if warehouse_id:
-            query += " AND sm.warehouse_id = %s"
-            params.append(warehouse_id)
-
-        if doc_type:
-            query += " AND d.doc_type = %s"
-            params.append(doc_type)
-
-        if date_from:
-            query += " AND sm.movement_date >= %s"
-            params.append(date_from)
-
-        if date_to:
-            query += " AND sm.movement_date <= %s"
-            params.append(date_to)
-
-        query += " ORDER BY sm.movement_date DESC, sm.created_at DESC"
+                  date_to: Optional[str] = None,
+                  limit: Optional[int] = Query(None, ge=1, le=1000),
+                  before_date: Optional[str] = None, before_created_at: Optional[str] = None,
+                  before_id: Optional[str] = None,
+                  current_user: dict = Depends(get_current_user)):
+    """Movements, newest first.
 
-        cursor.execute(query, params)
-        movements = cursor.fetchall()
-        return [dict(m) for m in movements]
-    finally:
-        cursor.close()
-        conn.close()
+    Page with limit plus the movement_date/created_at/id of the last row
+    already seen (before_date, before_created_at, before_id). The id breaks
+    ties between movements written by the same confirm, which share a
+    created_at.
+    """
+    query, params = filtered_query(
+        _MOVEMENT_QUERIES,
+        _MOVEMENT_FILTERS,
+        {"product_id": product_id, "warehouse_id": warehouse_id, "doc_type": doc_type,
+         "date_from": date_from, "date_to": date_to,
+         "before": (before_date, before_created_at, before_id)
+                   if before_date and before_created_at and before_id else None},
+        (limit,) if limit is not None else None,
+    )
+    if limit is not None:
+        return RowsResponse(fetch_all(query, params))
+    return stream_rows(query, params)
+
+_LOW_STOCK_QUERY = """
+    SELECT id, name, sku, min_stock, warehouse_id, warehouse_name, current_stock
+    FROM mv_low_stock
+    {where}
+    ORDER BY name
+"""
+_LOW_STOCK_ALL = _LOW_STOCK_QUERY.format(where="")
+_LOW_STOCK_BY_WAREHOUSE = _LOW_STOCK_QUERY.format(where="WHERE warehouse_id = %s")
 
 @app.get("/reports/low-stock")
 def get_low_stock(warehouse_id: Optional[str] = None, current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        query = """
-            SELECT p.id, p.name, p.sku, p.min_stock,
-                   w.id as warehouse_id, w.name as warehouse_name,
-                   COALESCE(SUM(cs.quantity), 0) as current_stock
-            FROM products p
-            CROSS JOIN warehouses w
-            LEFT JOIN current_stock cs ON p.id = cs.product_id AND w.id = cs.warehouse_id
-        """
-        params = []
-
-        if warehouse_id:
-            query += " WHERE w.id = %s"
-            params.append(warehouse_id)
-
-        query += """
-            GROUP BY p.id, p.name, p.sku, p.min_stock, w.id, w.name
-            HAVING COALESCE(SUM(cs.quantity), 0) < p.min_stock
-            ORDER BY p.name
-        """
+    if warehouse_id:
+        return RowsResponse(fetch_all(_LOW_STOCK_BY_WAREHOUSE, (warehouse_id,)))
+    return RowsResponse(fetch_all(_LOW_STOCK_ALL))
 
-        cursor.execute(query, params)
-        low_stock = cursor.fetchall()
-        return [dict(ls) for ls in low_stock]
-    finally:
-        cursor.close()
-        conn.close()
+_LEDGER_FILTERS = (
+    ("warehouse_id", "sm.warehouse_id = %s"),
+    ("location_id", "sm.location_id = %s"),
+)
+# The running balance is computed over every matching movement before
+# LIMIT/OFFSET apply, so a page still carries the true balance
+_LEDGER_QUERIES = compile_filtered_queries(
+    """SELECT sm.*,
+              SUM(sm.qty_change) OVER (
+                  ORDER BY sm.movement_date, sm.created_at, sm.id
+                  ROWS UNBOUNDED PRECEDING
+              ) as running_balance,
+              d.doc_type,
+              w.name as warehouse_name,
+              l1.name as location_name,
+              l2.name as from_location_name,
+              l3.name as to_location_name
+       FROM stock_movements sm
+       JOIN documents d ON sm.document_id = d.id
+       JOIN warehouses w ON sm.warehouse_id = w.id
+       JOIN locations l1 ON sm.location_id = l1.id
+       LEFT JOIN document_lines dl ON sm.document_line_id = dl.id
+       LEFT JOIN locations l2 ON dl.from_location_id = l2.id
+       LEFT JOIN locations l3 ON dl.to_location_id = l3.id
+       WHERE sm.product_id = %s""",
+    _LEDGER_FILTERS,
+    "ORDER BY sm.movement_date ASC, sm.created_at ASC, sm.id ASC",
+    "LIMIT %s OFFSET %s",
+)
 
 @app.get("/reports/ledger")
 def get_ledger(product_id: str, warehouse_id: Optional[str] = None,
-               location_id: Optional[str] = None, current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        query = """
-            SELECT sm.*,
-                   d.doc_type,
-                   w.name as warehouse_name,
-                   l1.name as location_name,
-                   l2.name as from_location_name,
-                   l3.name as to_location_name
-            FROM stock_movements sm
-            JOIN documents d ON sm.document_id = d.id
-            JOIN warehouses w ON sm.warehouse_id = w.id
-            JOIN locations l1 ON sm.location_id = l1.id
-            LEFT JOIN document_lines dl ON sm.document_line_id = dl.id
-            LEFT JOIN locations l2 ON dl.from_location_id = l2.id
-            LEFT JOIN locations l3 ON dl.to_location_id = l3.id
-            WHERE sm.product_id = %s
-        """
-        params = [product_id]
-
-        if warehouse_id:
-            query += " AND sm.warehouse_id = %s"
-            params.append(warehouse_id)
-
-        if location_id:
-            query += " AND sm.location_id = %s"
-            params.append(location_id)
-
-        query += " ORDER BY sm.movement_date ASC, sm.created_at ASC"
-
-        cursor.execute(query, params)
-        movements = cursor.fetchall()
-
-        running_balance = 0
-        ledger = []
-        for mov in movements:
-            running_balance += float(mov["qty_change"])
-            entry = dict(mov)
-            entry["running_balance"] = running_balance
-            ledger.append(entry)
-
-        return ledger
-    finally:
-        cursor.close()
-        conn.close()
+               location_id: Optional[str] = None,
+               limit: Optional[int] = Query(None, ge=1, le=1000), offset: int = Query(0, ge=0),
+               current_user: dict = Depends(get_current_user)):
+    query, params = filtered_query(
+        _LEDGER_QUERIES,
+        _LEDGER_FILTERS,
+        {"warehouse_id": warehouse_id, "location_id": location_id},
+        (limit, offset) if limit is not None else None,
+    )
+    return RowsResponse(fetch_all(query, [product_id, *params]))
 
 @app.get("/dashboard/summary")
 def get_dashboard_summary(current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute("SELECT COUNT(*) as count FROM products")
-        total_products = cursor.fetchone()["count"]
-
-        cursor.execute("""
-            SELECT COUNT(DISTINCT p.id) as count
-            FROM products p
-            LEFT JOIN (
-                SELECT product_id, SUM(quantity) as total_qty
-                FROM current_stock
-                GROUP BY product_id
-            ) cs ON p.id = cs.product_id
-            WHERE COALESCE(cs.total_qty, 0) < p.min_stock
-        """)
-        low_stock_count = cursor.fetchone()["count"]
-
-        cursor.execute("""
-            SELECT COUNT(*) as count FROM documents
-            WHERE doc_type = 'RECEIPT' AND status = 'DRAFT'
-        """)
-        pending_receipts = cursor.fetchone()["count"]
-
-        cursor.execute("""
-            SELECT COUNT(*) as count FROM documents
-            WHERE doc_type = 'DELIVERY' AND status = 'DRAFT'
-        """)
-        pending_deliveries = cursor.fetchone()["count"]
-
-        cursor.execute("""
-            SELECT COUNT(*) as count FROM documents
-            WHERE doc_type = 'TRANSFER' AND status = 'DRAFT'
-        """)
-        pending_transfers = cursor.fetchone()["count"]
-
-        cursor.execute("""
-            SELECT sm.*,
-                   p.name as product_name, p.sku as product_sku,
-                   w.name as warehouse_name,
-                   l.name as location_name,
-                   d.doc_type
-            FROM stock_movements sm
-            JOIN products p ON sm.product_id = p.id
-            JOIN warehouses w ON sm.warehouse_id = w.id
-            JOIN locations l ON sm.location_id = l.id
-            JOIN documents d ON sm.document_id = d.id
-            ORDER BY sm.created_at DESC
-            LIMIT 10
-        """)
-        last_movements = cursor.fetchall()
-
-        return {
-            "total_products": total_products,
-            "low_stock_count": low_stock_count,
-            "pending_receipts_count": pending_receipts,
-            "pending_deliveries_count": pending_deliveries,
-            "pending_transfers_count": pending_transfers,
-            "last_10_movements": [dict(m) for m in last_movements]
-        }
-    finally:
-        cursor.close()
-        conn.close()
+    return RowsResponse(cached_dashboard("dashboard:summary", load_dashboard_summary))
+
+def load_dashboard_summary():
+    # All counts and the latest movements in one round trip
+    return fetch_one(f"""
+        SELECT
+            (SELECT COUNT(*) FROM products) as total_products,
+            (
+                SELECT COUNT(DISTINCT p.id)
+                FROM products p
+                LEFT JOIN (
+                    SELECT product_id, SUM(quantity) as total_qty
+                    FROM current_stock
+                    GROUP BY product_id
+                ) cs ON p.id = cs.product_id
+                WHERE COALESCE(cs.total_qty, 0) < p.min_stock
+            ) as low_stock_count,
+            COUNT(*) FILTER (WHERE doc_type = 'RECEIPT') as pending_receipts_count,
+            COUNT(*) FILTER (WHERE doc_type = 'DELIVERY') as pending_deliveries_count,
+            COUNT(*) FILTER (WHERE doc_type = 'TRANSFER') as pending_transfers_count,
+            (
+                -- Built field by field so the JSON matches the row encoding used
+                -- elsewhere: numerics stay JSON numbers, and created_at is given
+                -- in the ISO form the row encoder produces (UTC), not jsonb's text
+                SELECT COALESCE(json_agg(json_build_object(
+                    'id', m.id,
+                    'product_id', m.product_id,
+                    'warehouse_id', m.warehouse_id,
+                    'location_id', m.location_id,
+                    'document_id', m.document_id,
+                    'document_line_id', m.document_line_id,
+                    'movement_date', m.movement_date,
+                    'qty_change', m.qty_change,
+                    'created_at', {json_timestamp("m.created_at")},
+                    'product_name', m.product_name,
+                    'product_sku', m.product_sku,
+                    'warehouse_name', m.warehouse_name,
+                    'location_name', m.location_name,
+                    'doc_type', m.doc_type
+                ) ORDER BY m.created_at DESC), '[]'::json)
+                FROM (
+                    SELECT sm.id, sm.product_id, sm.warehouse_id, sm.location_id,
+                           sm.document_id, sm.document_line_id, sm.movement_date,
+                           sm.qty_change, sm.created_at,
+                           p.name as product_name, p.sku as product_sku,
+                           w.name as warehouse_name,
+                           l.name as location_name,
+                           d.doc_type
+                    FROM stock_movements sm
+                    JOIN products p ON sm.product_id = p.id
+                    JOIN warehouses w ON sm.warehouse_id = w.id
+                    JOIN locations l ON sm.location_id = l.id
+                    JOIN documents d ON sm.document_id = d.id
+                    ORDER BY sm.created_at DESC
+                    LIMIT 10
+                ) m
+            ) as last_10_movements
+        FROM documents
+        WHERE status = 'DRAFT'
+    """)
 
 @app.get("/dashboard/risk-alerts")
 def get_risk_alerts(current_user: dict = Depends(get_current_user)):
-    conn, cursor = get_db_cursor()
-    try:
-        cursor.execute("""
-            WITH product_outflows AS (
-                SELECT
-                    product_id,
-                    AVG(ABS(qty_change)) as avg_daily_out
-                FROM stock_movements
-                WHERE qty_change < 0
-                  AND movement_date >= CURRENT_DATE - INTERVAL '30 days'
-                GROUP BY product_id
-                HAVING AVG(ABS(qty_change)) > 0
-            ),
-            current_totals AS (
-                SELECT product_id, SUM(quantity) as total_stock
-                FROM current_stock
-                GROUP BY product_id
-            )
-            SELECT
-                p.id, p.name, p.sku,
-                ct.total_stock as current_stock,
-                po.avg_daily_out,
-                CASE
-                    WHEN po.avg_daily_out > 0 THEN ct.total_stock / po.avg_daily_out
-                    ELSE 999
-                END as days_to_zero
-            FROM products p
-            LEFT JOIN current_totals ct ON p.id = ct.product_id
-            LEFT JOIN product_outflows po ON p.id = po.product_id
-            WHERE po.avg_daily_out > 0
-              AND ct.total_stock / po.avg_daily_out <= 7
-            ORDER BY days_to_zero ASC
-        """)
-        alerts = cursor.fetchall()
-        return [dict(a) for a in alerts]
-    finally:
-        cursor.close()
-        conn.close()
+    return RowsResponse(cached_dashboard("dashboard:risk-alerts", load_risk_alerts))
+
+def load_risk_alerts():
+    return fetch_all("""
+        SELECT id, name, sku, current_stock, avg_daily_out, days_to_zero
+        FROM mv_risk_alerts
+        ORDER BY days_to_zero ASC
+    """)
+
+# Typeahead lookups repeat the same few prefixes on every keystroke, so
+# matches (including "no match") are kept briefly per search term.
+_PRODUCT_MATCH_CACHE = TTLCache(maxsize=1024, ttl=30)
+_PRODUCT_MATCH_CACHE_LOCK = threading.Lock()
+_NO_MATCH = object()
+
+_SUGGESTION_PREFIXES = (
+    ("stock of ", "NAVIGATE_STOCK"),
+    ("movements of ", "NAVIGATE_MOVEMENTS"),
+)
+
+def find_product_match(search: str):
+    if not search:
+        # "%%" would match every product; an empty term never names one
+        return None
+    with _PRODUCT_MATCH_CACHE_LOCK:
+        product = _PRODUCT_MATCH_CACHE.get(search)
+    if product is None:
+        # LOWER(...) LIKE is served by the trigram indexes on products.
+        # Wildcards typed by the user are matched literally.
+        escaped = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        pattern = f"%{escaped}%"
+        product = fetch_one(
+            "SELECT id, name, sku FROM products WHERE LOWER(name) LIKE %s OR LOWER(sku) LIKE %s LIMIT 1",
+            (pattern, pattern)
+        ) or _NO_MATCH
+        with _PRODUCT_MATCH_CACHE_LOCK:
+            _PRODUCT_MATCH_CACHE[search] = product
+    return None if product is _NO_MATCH else product
 
 @app.get("/search/suggestions")
 def search_suggestions(q: str, current_user: dict = Depends(get_current_user)):
@@ -1689,43 +1623,17 @@ def search_suggestions(q: str, current_user: dict = Depends(get_current_user)):
     if q_lower == "low stock":
         return {"type": "NAVIGATE_LOW_STOCK"}
 
-    if q_lower.startswith("stock of "):
-        product_search = q_lower.replace("stock of ", "").strip()
-        conn, cursor = get_db_cursor()
-        try:
-            cursor.execute(
-                "SELECT id, name, sku FROM products WHERE LOWER(name) LIKE %s OR LOWER(sku) LIKE %s LIMIT 1",
-                (f"%{product_search}%", f"%{product_search}%")
-            )
-            product = cursor.fetchone()
+    # The prefixes are exclusive, so at most one product lookup runs
+    for prefix, action in _SUGGESTION_PREFIXES:
+        if q_lower.startswith(prefix):
+            product = find_product_match(q_lower[len(prefix):].strip())
             if product:
                 return {
-                    "type": "NAVIGATE_STOCK",
+                    "type": action,
                     "product_id": product["id"],
                     "product_name": product["name"]
                 }
-        finally:
-            cursor.close()
-            conn.close()
-
-    if q_lower.startswith("movements of "):
-        product_search = q_lower.replace("movements of ", "").strip()
-        conn, cursor = get_db_cursor()
-        try:
-            cursor.execute(
-                "SELECT id, name, sku FROM products WHERE LOWER(name) LIKE %s OR LOWER(sku) LIKE %s LIMIT 1",
-                (f"%{product_search}%", f"%{product_search}%")
-            )
-            product = cursor.fetchone()
-            if product:
-                return {
-                    "type": "NAVIGATE_MOVEMENTS",
-                    "product_id": product["id"],
-                    "product_name": product["name"]
-                }
-        finally:
-            cursor.close()
-            conn.close()
+            break
 
     return {"type": "NO_MATCH"}
 
@@ -1875,8 +1783,7 @@ def smart_search(q: str, current_user: dict = Depends(get_current_user)):
         return results[:10]  # Limit to top 10 results
         
     finally:
-        cursor.close()
-        conn.close()
+        release_db_cursor(conn, cursor)
 
 if __name__ == "__main__":
     import uvicorn
@@ -3,19 +3,39 @@ Password Reset Module using Supabase OTP
 This module handles OTP generation and verification for password reset functionality
 """
 
+import hmac
+import logging
 import os
+import random
+import re
 import secrets
-import string
-from datetime import datetime, timedelta
+import threading
+import time
+from cachetools import TTLCache
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from dotenv import load_dotenv
-from database import get_db_cursor
-from auth import get_password_hash
+from database import db_transaction
+import cache
+
+try:
+    import resend
+except ImportError:
+    resend = None
+
+logger = logging.getLogger(__name__)
 
 # Load .env from parent directory (root of project)
 env_path = Path(__file__).parent.parent / '.env'
 load_dotenv(dotenv_path=env_path)
 
+# Resend is configured once at import rather than on every email
+RESEND_API_KEY = os.getenv("RESEND_API_KEY")
+FROM_EMAIL = os.getenv("FROM_EMAIL", "onboarding@yourdomain.com")
+RESEND_CONFIGURED = bool(RESEND_API_KEY) and RESEND_API_KEY != "your_resend_api_key_here"
+if resend is not None and RESEND_CONFIGURED:
+    resend.api_key = RESEND_API_KEY
+
 # Note: We don't actually need Supabase client for OTP functionality
 # The email sending uses Resend, and database uses PostgreSQL directly
 # Removing unused Supabase initialization
@@ -24,226 +44,309 @@ load_dotenv(dotenv_path=env_path)
 OTP_LENGTH = 6
 OTP_EXPIRY_MINUTES = 10
 
+# Rate limits per email: one OTP email a minute, and five verify attempts per
+# ten minutes, so the 6-digit code can't be brute-forced in its lifetime
+OTP_SEND_LIMIT = 1
+OTP_SEND_WINDOW = 60
+OTP_VERIFY_LIMIT = 5
+OTP_VERIFY_WINDOW = 600
+
+# Resend retries: rate limits (429), server errors and network failures are
+# retried with exponential backoff and jitter; other 4xx errors fail at once
+EMAIL_SEND_ATTEMPTS = 4
+EMAIL_RETRY_MAX_DELAY = 30
+
 def generate_otp(length: int = OTP_LENGTH) -> str:
     """Generate a random numeric OTP"""
-    return ''.join(secrets.choice(string.digits) for _ in range(length))
+    # One uniform draw over all length-digit codes (randbelow rejection-samples,
+    # so there's no modulo bias), zero-padded to keep leading zeros
+    return f"{secrets.randbelow(10 ** length):0{length}d}"
+
+# Per-process counters used when Redis is not available
+_RATE_COUNTS = TTLCache(maxsize=10_000, ttl=max(OTP_SEND_WINDOW, OTP_VERIFY_WINDOW))
+_RATE_COUNTS_LOCK = threading.Lock()
+
+def check_rate(key: str, limit: int, window: int) -> int:
+    """Counts one attempt against key.
+
+    Returns 0 if it is within limit per window, otherwise the seconds until
+    the window resets.
+    """
+    hit = cache.incr_window(key, window)
+    if hit is None:
+        now = time.monotonic()
+        with _RATE_COUNTS_LOCK:
+            count, reset_at = _RATE_COUNTS.get(key, (0, now + window))
+            if reset_at <= now:
+                count, reset_at = 0, now + window
+            count += 1
+            _RATE_COUNTS[key] = (count, reset_at)
+        hit = count, int(reset_at - now)
+    count, seconds_left = hit
+    return 0 if count <= limit else max(seconds_left, 1)
+
+# Cheap shape checks run before any Redis or database work, so malformed
+# requests are turned away in-process
+_EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+
+def is_valid_email(email: str) -> bool:
+    return bool(email) and len(email) <= 254 and _EMAIL_RE.fullmatch(email) is not None
+
+def is_valid_otp(otp: str) -> bool:
+    # isascii() too: isdigit() also accepts digits like "²"
+    return bool(otp) and len(otp) == OTP_LENGTH and otp.isascii() and otp.isdigit()
+
+def _otp_matches(stored_otp: str, otp: str) -> bool:
+    # Constant-time, so response timing doesn't reveal how many leading
+    # characters of a guess were right. Compared as bytes because
+    # compare_digest rejects non-ASCII str.
+    return hmac.compare_digest((stored_otp or "").encode(), (otp or "").encode())
+
+def _otp_key(email: str) -> str:
+    return f"otp:{email}"
 
 def store_otp(email: str, otp: str) -> bool:
-    """Store OTP in database with expiry time"""
-    conn, cursor = get_db_cursor()
+    """Store OTP with expiry time
+
+    With Redis configured the OTP is a key that expires on its own and
+    replaces any earlier one. The database table is only used when Redis is
+    unavailable. Either way the other store's OTP for the email is discarded,
+    so only the newest OTP can ever be used.
+    """
+    if not is_valid_email(email):
+        return False
+
     try:
-        from datetime import timezone
+        if cache.set_text(_otp_key(email), otp, OTP_EXPIRY_MINUTES * 60):
+            # An OTP stored in the table while Redis was down would otherwise
+            # become usable again once this one is used or expires
+            with db_transaction() as cursor:
+                cursor.execute("DELETE FROM password_reset_otps WHERE email = %s", (email,))
+            return True
+
+        # Drop a Redis OTP left from before a partial outage; verify_otp
+        # checks Redis first and would keep accepting it
+        cache.delete(_otp_key(email))
+
         # Use timezone-aware datetime to match database timestamptz
         current_time = datetime.now(timezone.utc)
         expiry_time = current_time + timedelta(minutes=OTP_EXPIRY_MINUTES)
         
-        # Delete any existing OTPs for this email
-        cursor.execute(
-            "DELETE FROM password_reset_otps WHERE email = %s",
-            (email,)
-        )
-        
-        # Insert new OTP
-        cursor.execute(
-            """INSERT INTO password_reset_otps (email, otp, expires_at, created_at)
-               VALUES (%s, %s, %s, %s)""",
-            (email, otp, expiry_time, current_time)
-        )
-        conn.commit()
+        with db_transaction() as cursor:
+            # Replace any existing OTP for this email (one row per email)
+            cursor.execute(
+                """INSERT INTO password_reset_otps (email, otp, expires_at, created_at)
+                   VALUES (%s, %s, %s, %s)
+                   ON CONFLICT (email) DO UPDATE SET
+                       otp = EXCLUDED.otp, expires_at = EXCLUDED.expires_at,
+                       created_at = EXCLUDED.created_at""",
+                (email, otp, expiry_time, current_time)
+            )
         return True
-    except Exception as e:
-        conn.rollback()
-        print(f"Error storing OTP: {e}")
+    except Exception:
+        logger.exception("Error storing OTP")
         return False
-    finally:
-        cursor.close()
-        conn.close()
 
 def verify_otp(email: str, otp: str) -> bool:
-    """Verify if the OTP is valid and not expired"""
-    conn, cursor = get_db_cursor()
+    """Verify if the OTP is valid and not expired, consuming it on success"""
+    if not is_valid_otp(otp) or not is_valid_email(email):
+        return False
+
+    key = _otp_key(email)
+    stored_otp = cache.get_text(key)
+    if stored_otp is not None:
+        # Only the caller whose DEL removes the key gets to use the OTP
+        return _otp_matches(stored_otp, otp) and cache.delete(key) == 1
+
+    # Not in Redis: it may have been stored in the database while Redis was down.
+    # Matching, expiry and consuming it happen in one atomic DELETE, so two
+    # concurrent verifies can't both succeed.
     try:
-        cursor.execute(
-            """SELECT otp, expires_at FROM password_reset_otps 
-               WHERE email = %s AND is_used = FALSE
-               ORDER BY created_at DESC LIMIT 1""",
-            (email,)
-        )
-        result = cursor.fetchone()
-        
-        if not result:
-            return False
-        
-        stored_otp = result['otp']
-        expires_at = result['expires_at']
-        
-        # Make current time timezone-aware to match database timestamp
-        from datetime import timezone
-        current_time = datetime.now(timezone.utc)
-        
-        # Check if OTP matches and is not expired
-        if stored_otp == otp and current_time < expires_at:
-            # Mark OTP as used
+        with db_transaction() as cursor:
             cursor.execute(
-                "UPDATE password_reset_otps SET is_used = TRUE WHERE email = %s AND otp = %s",
+                """DELETE FROM password_reset_otps
+                   WHERE email = %s AND otp = %s AND expires_at > now()
+                   RETURNING 1""",
                 (email, otp)
             )
-            conn.commit()
-            return True
-        
+            return cursor.fetchone() is not None
+    except Exception:
+        logger.exception("Error verifying OTP")
         return False
-    except Exception as e:
-        print(f"Error verifying OTP: {e}")
-        return False
-    finally:
-        cursor.close()
-        conn.close()
+
+def purge_expired_otps() -> int:
+    """Deletes expired database OTPs; returns how many."""
+    with db_transaction() as cursor:
+        cursor.execute("DELETE FROM password_reset_otps WHERE expires_at < now()")
+        return cursor.rowcount
+
+def invalidate_otps(emails: list[str]) -> int:
+    """Discards any pending OTPs for the given emails, e.g. after a suspected leak.
+
+    The database rows go in a single DELETE with the emails sent as one array
+    parameter, however many there are. Returns how many rows were deleted.
+    """
+    if not emails:
+        return 0
+    cache.delete(*(_otp_key(email) for email in emails))
+    with db_transaction() as cursor:
+        cursor.execute("DELETE FROM password_reset_otps WHERE email = ANY(%s)", (list(emails),))
+        return cursor.rowcount
+
+def _is_retryable_send_error(exc: Exception) -> bool:
+    code = getattr(exc, "code", None)
+    if code is not None:
+        try:
+            code = int(code)
+        except (TypeError, ValueError):
+            return False
+        return code == 429 or code >= 500
+    # No HTTP status: connection errors and timeouts (requests' exceptions are OSErrors)
+    return isinstance(exc, OSError)
+
+def _send_with_retry(send, params):
+    for attempt in range(EMAIL_SEND_ATTEMPTS):
+        try:
+            return send(params)
+        except Exception as e:
+            if attempt == EMAIL_SEND_ATTEMPTS - 1 or not _is_retryable_send_error(e):
+                raise
+            time.sleep(min(2 ** attempt, EMAIL_RETRY_MAX_DELAY) * random.uniform(0.5, 1.0))
+
+# Rendered once at import and split around {otp}, so each email is a single
+# concatenation instead of a search through the whole template
+_OTP_EMAIL_TEMPLATE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <style>
+        body {
+            font-family: Arial, sans-serif;
+            line-height: 1.6;
+            color: #333;
+        }
+        .container {
+            max-width: 600px;
+            margin: 0 auto;
+            padding: 20px;
+        }
+        .header {
+            background-color: #4F46E5;
+            color: white;
+            padding: 20px;
+            text-align: center;
+            border-radius: 5px 5px 0 0;
+        }
+        .content {
+            background-color: #f9f9f9;
+            padding: 30px;
+            border-radius: 0 0 5px 5px;
+        }
+        .otp-box {
+            background-color: white;
+            border: 2px dashed #4F46E5;
+            padding: 20px;
+            text-align: center;
+            margin: 20px 0;
+            border-radius: 5px;
+        }
+        .otp-code {
+            font-size: 32px;
+            font-weight: bold;
+            letter-spacing: 5px;
+            color: #4F46E5;
+        }
+        .footer {
+            text-align: center;
+            margin-top: 20px;
+            font-size: 12px;
+            color: #666;
+        }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h1>🔐 Password Reset Request</h1>
+        </div>
+        <div class="content">
+            <h2>Hello!</h2>
+            <p>You recently requested to reset your password for your StockTrace account.</p>
+            <p>Use the following One-Time Password (OTP) to complete your password reset:</p>
+            
+            <div class="otp-box">
+                <div class="otp-code">{otp}</div>
+            </div>
+            
+            <p><strong>⏰ This OTP will expire in {minutes} minutes.</strong></p>
+            
+            <p>If you didn't request a password reset, please ignore this email or contact support if you have concerns.</p>
+            
+            <div class="footer">
+                <p>This is an automated message from StockTrace Inventory Management System.</p>
+                <p>Please do not reply to this email.</p>
+            </div>
+        </div>
+    </div>
+</body>
+</html>
+""".replace("{minutes}", str(OTP_EXPIRY_MINUTES))
+_OTP_EMAIL_HEAD, _OTP_EMAIL_TAIL = _OTP_EMAIL_TEMPLATE.split("{otp}")
 
 def send_otp_email(email: str, otp: str) -> bool:
     """Send OTP via email using Resend email service"""
+    if resend is None:
+        logger.warning("Resend package not installed (pip install resend). OTP for %s: %s", email, otp)
+        return True  # Return True for development
+    
+    # Check if Resend is configured
+    if not RESEND_CONFIGURED:
+        logger.warning(
+            "Resend not configured (set RESEND_API_KEY from https://resend.com in .env). OTP for %s: %s",
+            email, otp
+        )
+        return True  # Return True for development
+    
     try:
-        import resend
-        
-        # Get configuration from environment
-        resend_api_key = os.getenv("RESEND_API_KEY")
-        from_email = os.getenv("FROM_EMAIL", "onboarding@yourdomain.com")
-        
-        # Check if Resend is configured
-        if not resend_api_key or resend_api_key == "your_resend_api_key_here":
-            print(f"⚠️  Resend not configured. OTP for {email}: {otp}")
-            print("📧 To enable email sending:")
-            print("1. Sign up at https://resend.com")
-            print("2. Get your API key")
-            print("3. Add RESEND_API_KEY to .env file")
-            return True  # Return True for development
-        
-        # Configure Resend
-        resend.api_key = resend_api_key
-        
-        # Create HTML email template
-        html_content = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <style>
-                body {{
-                    font-family: Arial, sans-serif;
-                    line-height: 1.6;
-                    color: #333;
-                }}
-                .container {{
-                    max-width: 600px;
-                    margin: 0 auto;
-                    padding: 20px;
-                }}
-                .header {{
-                    background-color: #4F46E5;
-                    color: white;
-                    padding: 20px;
-                    text-align: center;
-                    border-radius: 5px 5px 0 0;
-                }}
-                .content {{
-                    background-color: #f9f9f9;
-                    padding: 30px;
-                    border-radius: 0 0 5px 5px;
-                }}
-                .otp-box {{
-                    background-color: white;
-                    border: 2px dashed #4F46E5;
-                    padding: 20px;
-                    text-align: center;
-                    margin: 20px 0;
-                    border-radius: 5px;
-                }}
-                .otp-code {{
-                    font-size: 32px;
-                    font-weight: bold;
-                    letter-spacing: 5px;
-                    color: #4F46E5;
-                }}
-                .footer {{
-                    text-align: center;
-                    margin-top: 20px;
-                    font-size: 12px;
-                    color: #666;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>🔐 Password Reset Request</h1>
-                </div>
-                <div class="content">
-                    <h2>Hello!</h2>
-                    <p>You recently requested to reset your password for your StockTrace account.</p>
-                    <p>Use the following One-Time Password (OTP) to complete your password reset:</p>
-                    
-                    <div class="otp-box">
-                        <div class="otp-code">{otp}</div>
-                    </div>
-                    
-                    <p><strong>⏰ This OTP will expire in {OTP_EXPIRY_MINUTES} minutes.</strong></p>
-                    
-                    <p>If you didn't request a password reset, please ignore this email or contact support if you have concerns.</p>
-                    
-                    <div class="footer">
-                        <p>This is an automated message from StockTrace Inventory Management System.</p>
-                        <p>Please do not reply to this email.</p>
-                    </div>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
+        html_content = _OTP_EMAIL_HEAD + otp + _OTP_EMAIL_TAIL
         
         # Send email via Resend
         params = {
-            "from": from_email,
+            "from": FROM_EMAIL,
             "to": [email],
             "subject": "Your Password Reset OTP - StockTrace",
             "html": html_content,
         }
         
-        response = resend.Emails.send(params)
-        print(f"✅ OTP email sent successfully to {email}. Email ID: {response.get('id')}")
+        response = _send_with_retry(resend.Emails.send, params)
+        logger.info("OTP email sent to %s, email id %s", email, response.get("id"))
         return True
         
-    except ImportError:
-        print(f"⚠️  Resend package not installed. OTP for {email}: {otp}")
-        print("Run: pip install resend")
-        return True  # Return True for development
-    except Exception as e:
-        print(f"❌ Error sending OTP email: {e}")
-        print(f"🔍 Debug - OTP for {email}: {otp}")
+    except Exception:
+        logger.exception("Error sending OTP email to %s", email)
+        logger.debug("OTP for %s: %s", email, otp)
         return False
 
-def reset_password_with_otp(email: str, new_password: str) -> bool:
-    """Reset user password after OTP verification"""
-    conn, cursor = get_db_cursor()
+def reset_password_with_otp(email: str, password_hash: str) -> bool:
+    """Store a new password hash after OTP verification
+
+    The caller hashes the password first, so no pooled connection is held
+    during the hashing work.
+    """
     try:
-        # Hash the new password
-        password_hash = get_password_hash(new_password)
-        
-        # Update user password
-        cursor.execute(
-            "UPDATE users SET password_hash = %s WHERE email = %s",
-            (password_hash, email)
-        )
-        
-        if cursor.rowcount == 0:
-            return False
-        
-        # Delete all OTPs for this email
-        cursor.execute("DELETE FROM password_reset_otps WHERE email = %s", (email,))
-        
-        conn.commit()
+        with db_transaction() as cursor:
+            # Update user password
+            cursor.execute(
+                "UPDATE users SET password_hash = %s WHERE email = %s RETURNING 1",
+                (password_hash, email)
+            )
+            
+            if cursor.fetchone() is None:
+                return False
+            
+            # Delete all OTPs for this email
+            cursor.execute("DELETE FROM password_reset_otps WHERE email = %s", (email,))
         return True
-    except Exception as e:
-        conn.rollback()
-        print(f"Error resetting password: {e}")
+    except Exception:
+        logger.exception("Error resetting password")
         return False
-    finally:
-        cursor.close()
-        conn.close()
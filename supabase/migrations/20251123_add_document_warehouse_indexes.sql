@@ -0,0 +1,6 @@
+-- One index per warehouse column used by the document list warehouse filter,
+-- so each branch of its UNION ALL is an index scan
+
+CREATE INDEX IF NOT EXISTS idx_documents_type_warehouse ON documents(doc_type, warehouse_id, date DESC);
+CREATE INDEX IF NOT EXISTS idx_documents_type_from_warehouse ON documents(doc_type, from_warehouse_id, date DESC);
+CREATE INDEX IF NOT EXISTS idx_documents_type_to_warehouse ON documents(doc_type, to_warehouse_id, date DESC);
@@ -0,0 +1,5 @@
+-- Movement list (newest first, paged on movement_date/created_at) and the
+-- per-product stock ledger
+
+CREATE INDEX IF NOT EXISTS idx_stock_movements_date_created ON stock_movements(movement_date DESC, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_stock_movements_product_date ON stock_movements(product_id, movement_date, created_at);
@@ -0,0 +1,7 @@
+-- Trigram indexes so the product typeahead's LOWER(name/sku) LIKE '%term%'
+-- lookups don't scan the whole products table
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_products_name_trgm ON products USING gin (lower(name) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_products_sku_trgm ON products USING gin (lower(sku) gin_trgm_ops);
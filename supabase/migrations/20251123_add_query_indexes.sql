@@ -0,0 +1,12 @@
+-- Indexes for the hot lookups in the API
+
+-- Document lists: WHERE doc_type = ... ORDER BY date DESC, created_at DESC
+CREATE INDEX IF NOT EXISTS idx_documents_type_date ON documents(doc_type, date DESC, created_at DESC);
+
+-- "Has stock" checks before deleting a product: only positive rows matter
+CREATE INDEX IF NOT EXISTS idx_current_stock_product_positive ON current_stock(product_id) WHERE quantity > 0;
+
+-- "Referenced by a document" check before deleting a product
+CREATE INDEX IF NOT EXISTS idx_document_lines_product ON document_lines(product_id);
+
+-- users.email (UNIQUE) and locations(warehouse_id) are already indexed
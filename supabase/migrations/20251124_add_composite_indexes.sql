@@ -0,0 +1,14 @@
+-- Composite indexes for the filtered read paths:
+--   movements and ledger filtered by product and warehouse, in date order
+--   movements filtered by warehouse only, newest first
+--   document lists filtered by status, newest first
+-- document_lines(document_id) and the current_stock (product, warehouse,
+-- location) key are already covered by the initial schema.
+
+CREATE INDEX IF NOT EXISTS idx_stock_movements_product_warehouse_date ON stock_movements(product_id, warehouse_id, movement_date, created_at);
+CREATE INDEX IF NOT EXISTS idx_stock_movements_warehouse_date ON stock_movements(warehouse_id, movement_date DESC, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_documents_type_status_date ON documents(doc_type, status, date DESC, created_at DESC);
+
+-- Superseded by the composite indexes above and in earlier migrations
+DROP INDEX IF EXISTS idx_stock_movements_warehouse;
+DROP INDEX IF EXISTS idx_documents_type;
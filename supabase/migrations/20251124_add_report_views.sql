@@ -0,0 +1,50 @@
+-- Precomputed low-stock and risk-alert reports. The API refreshes both views
+-- (CONCURRENTLY, so reads are never blocked) after every document confirm and
+-- every product or warehouse change. The unique indexes are required for
+-- concurrent refresh.
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_low_stock AS
+SELECT p.id, p.name, p.sku, p.min_stock,
+       w.id as warehouse_id, w.name as warehouse_name,
+       COALESCE(SUM(cs.quantity), 0) as current_stock
+FROM products p
+CROSS JOIN warehouses w
+LEFT JOIN current_stock cs ON p.id = cs.product_id AND w.id = cs.warehouse_id
+GROUP BY p.id, p.name, p.sku, p.min_stock, w.id, w.name
+HAVING COALESCE(SUM(cs.quantity), 0) < p.min_stock;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_low_stock_product_warehouse ON mv_low_stock(id, warehouse_id);
+CREATE INDEX IF NOT EXISTS idx_mv_low_stock_warehouse ON mv_low_stock(warehouse_id);
+
+-- The 30-day window is evaluated at refresh time
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_risk_alerts AS
+WITH product_outflows AS (
+    SELECT
+        product_id,
+        AVG(ABS(qty_change)) as avg_daily_out
+    FROM stock_movements
+    WHERE qty_change < 0
+      AND movement_date >= CURRENT_DATE - INTERVAL '30 days'
+    GROUP BY product_id
+    HAVING AVG(ABS(qty_change)) > 0
+),
+current_totals AS (
+    SELECT product_id, SUM(quantity) as total_stock
+    FROM current_stock
+    GROUP BY product_id
+)
+SELECT
+    p.id, p.name, p.sku,
+    ct.total_stock as current_stock,
+    po.avg_daily_out,
+    CASE
+        WHEN po.avg_daily_out > 0 THEN ct.total_stock / po.avg_daily_out
+        ELSE 999
+    END as days_to_zero
+FROM products p
+LEFT JOIN current_totals ct ON p.id = ct.product_id
+LEFT JOIN product_outflows po ON p.id = po.product_id
+WHERE po.avg_daily_out > 0
+  AND ct.total_stock / po.avg_daily_out <= 7;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_risk_alerts_product ON mv_risk_alerts(id);
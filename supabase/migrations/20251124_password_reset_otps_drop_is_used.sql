@@ -0,0 +1,5 @@
+-- OTPs are deleted when they are used, so the is_used flag is no longer needed
+
+DELETE FROM password_reset_otps WHERE is_used;
+
+ALTER TABLE password_reset_otps DROP COLUMN IF EXISTS is_used;
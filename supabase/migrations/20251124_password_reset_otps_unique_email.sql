@@ -0,0 +1,12 @@
+-- One OTP row per email, so storing a new OTP is a single upsert
+
+-- Keep only the newest OTP per email before adding the unique index
+DELETE FROM password_reset_otps o
+USING password_reset_otps newer
+WHERE newer.email = o.email
+  AND (newer.created_at, newer.id) > (o.created_at, o.id);
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_password_reset_otps_email ON password_reset_otps(email);
+
+-- Superseded by the unique index
+DROP INDEX IF EXISTS idx_password_reset_otps_email;
@@ -0,0 +1,9 @@
+-- The movement list pages on (movement_date, created_at, id): movements from
+-- one confirm share created_at, so id is needed to make the cursor unique
+
+CREATE INDEX IF NOT EXISTS idx_stock_movements_date_created_id ON stock_movements(movement_date DESC, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_stock_movements_warehouse_date_id ON stock_movements(warehouse_id, movement_date DESC, created_at DESC, id DESC);
+
+-- Superseded by the indexes above
+DROP INDEX IF EXISTS idx_stock_movements_date_created;
+DROP INDEX IF EXISTS idx_stock_movements_warehouse_date;